@@ -0,0 +1,204 @@
+"""
+Headless benchmarks for RPGOnline.
+
+Runs without a window or sound card (SDL's dummy drivers), so it works on a server or in CI:
+ - load_assets: loading everything in data/ through the asset loader
+ - build_main_menu: creating the main menu UI
+ - menu_events: a synthetic stream of mouse events going through UIGroupStepper.handle_event
+ - menu_frames_static / menu_frames_hover: frames of the main menu render loop, with the mouse still and with it moving over the buttons
+
+Every benchmark reports its median time, the memory blocks Python allocated while it ran and its peak memory (tracemalloc) as JSON.
+Run it from the game folder:
+    python data/benchmark.py                  compare against data/benchmark_baseline.json, if there is one
+    python data/benchmark.py --save-baseline  store this run as the baseline
+It exits with 1 when something got slower, or allocates more, than the baseline by more than the tolerance.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import pygame
+import main
+import modules.UIHandler as UI
+
+BASELINE_PATH = "data/benchmark_baseline.json"
+SCREEN_SIZE = (800, 600)
+
+class AllocationCounter():
+    """
+    Counts the memory blocks Python allocates, step by step. The benchmarks call step() once per frame (or poll), so garbage that's made and freed in one frame still shows up.
+    Blocks freed in the same step they were allocated in can't be seen, so it's a lower bound, but a stable one.
+    """
+    def __init__(self) -> None:
+        self.blocks = sys.getallocatedblocks()
+        self.allocated = 0
+
+    def step(self):
+        blocks = sys.getallocatedblocks()
+        self.allocated += max(blocks - self.blocks, 0)
+        self.blocks = blocks
+
+def measure(function, repeats):
+    """
+    Runs 'function' 'repeats' times, returns the median time, then the allocations and peak memory of one more run.
+    'function' gets a step callback to call once per frame, it's a no-op while timing.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(lambda: None)
+        times.append(time.perf_counter() - start)
+
+    counter = AllocationCounter()
+    function(counter.step)
+    counter.step()
+
+    tracemalloc.start()
+    function(lambda: None)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "median_ms": statistics.median(times) * 1000,
+        "min_ms": min(times) * 1000,
+        "allocations": counter.allocated,
+        "peak_kib": peak / 1024,
+    }
+
+def load_all_assets(step=lambda: None):
+    assets, loader = main.load_assets()
+    while not loader.finished:
+        loader.poll()
+        step()
+        time.sleep(0.0005)
+    loader.shutdown()
+    return assets
+
+def mouse_events(count, seed=1):
+    """A repeatable stream of mouse motion with some clicks in it, mostly over the menu buttons."""
+    generator = random.Random(seed)
+    events = []
+    x, y = 100, 300
+    for _ in range(count):
+        x = min(max(x + generator.randint(-12, 12), 0), SCREEN_SIZE[0] - 1)
+        y = min(max(y + generator.randint(-12, 12), 0), SCREEN_SIZE[1] - 1)
+        events.append(pygame.event.Event(pygame.MOUSEMOTION, pos=(x, y), rel=(0, 0), buttons=(0, 0, 0)))
+        if generator.random() < 0.02:
+            events.append(pygame.event.Event(pygame.MOUSEBUTTONDOWN, pos=(x, y), button=1))
+            events.append(pygame.event.Event(pygame.MOUSEBUTTONUP, pos=(x, y), button=1))
+    return events
+
+def run_benchmarks(frames, repeats):
+    screen = pygame.display.set_mode(SCREEN_SIZE)
+    results = {}
+
+    results["load_assets"] = measure(load_all_assets, repeats)
+    assets = load_all_assets()
+
+    results["build_main_menu"] = measure(lambda step: main.create_main_menu(SCREEN_SIZE[1]), repeats)
+
+    # The buttons would print and quit, swap the handlers for ones that do nothing
+    menu = main.create_main_menu(SCREEN_SIZE[1])
+    for element in menu.elements:
+        if isinstance(element, UI.UITextButton):
+            element.on_click = lambda: None
+
+    # Handled the way the main loop does it, a few events per frame, coalesced
+    events = mouse_events(frames * 4)
+    def replay_events(step):
+        for start in range(0, len(events), 4):
+            for event in UI.coalesce_events(events[start:start + 4]):
+                menu.handle_event(event)
+            step()
+    results["menu_events"] = measure(replay_events, repeats)
+
+    backdrop = [None, None]
+    def static_frames(step):
+        for _ in range(frames):
+            pygame.display.update(main.render_main_menu(screen, assets, menu, backdrop))
+            step()
+    results["menu_frames_static"] = measure(static_frames, repeats)
+
+    hover_events = mouse_events(frames, seed=2)
+    def hover_frames(step):
+        for event in hover_events:
+            menu.handle_event(event)
+            pygame.display.update(main.render_main_menu(screen, assets, menu, backdrop))
+            step()
+    results["menu_frames_hover"] = measure(hover_frames, repeats)
+
+    return results
+
+def compare(results, baseline, tolerance, allocation_tolerance, allocation_slack=64):
+    """
+    Prints how each benchmark did against the baseline, returns the names of the ones that regressed.
+    Allocations regress when they grow by more than 'allocation_tolerance' and by more than 'allocation_slack' blocks, so a benchmark that barely allocates doesn't fail over a few blocks.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]["median_ms"]
+        new = result["median_ms"]
+        change = (new - old) / old if old else 0
+        print(f"{name:20} {old:10.3f} ms -> {new:10.3f} ms ({change:+.1%})", file=sys.stderr)
+        if change > tolerance:
+            regressions.append(name)
+
+        old_allocations = baseline[name].get("allocations")
+        if old_allocations is None:
+            continue
+        new_allocations = result["allocations"]
+        allocation_change = (new_allocations - old_allocations) / old_allocations if old_allocations else 0
+        print(f"{'':20} {old_allocations:10} blocks -> {new_allocations:10} blocks ({allocation_change:+.1%})", file=sys.stderr)
+        if new_allocations - old_allocations > max(old_allocations * allocation_tolerance, allocation_slack):
+            regressions.append(f"{name} (allocations)")
+    return regressions
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Headless benchmarks for RPGOnline.")
+    parser.add_argument("--frames", type=int, default=300, help="frames per render benchmark")
+    parser.add_argument("--repeats", type=int, default=5, help="runs per benchmark, the median is reported")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline file to compare against or save to")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="how much slower than the baseline counts as a regression (0.25 = 25%%)")
+    parser.add_argument("--allocation-tolerance", type=float, default=0.25, help="how many more allocations than the baseline count as a regression (0.25 = 25%%)")
+    parser.add_argument("--output", help="also write the results to this file")
+    arguments = parser.parse_args()
+
+    # The resource manager logs every asset it loads, keep stdout for the results
+    with contextlib.redirect_stdout(sys.stderr):
+        pygame.init()
+        results = run_benchmarks(arguments.frames, arguments.repeats)
+        pygame.quit()
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if arguments.output:
+        with open(arguments.output, "w") as file:
+            file.write(output)
+
+    if arguments.save_baseline:
+        with open(arguments.baseline, "w") as file:
+            file.write(output)
+        print(f"Saved baseline to '{arguments.baseline}'", file=sys.stderr)
+    elif os.path.exists(arguments.baseline):
+        with open(arguments.baseline) as file:
+            regressions = compare(results, json.load(file), arguments.tolerance, arguments.allocation_tolerance)
+        if regressions:
+            print(f"Worse than the baseline: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -4,63 +4,98 @@ import pygame
 import os
 import modules.resourcemanager as ResourceManager
 import modules.UIHandler as UI
+import modules.assetpack as AssetPack
+import modules.gameloop as GameLoop
+import modules.netclient as NetClient
+import modules.settings as Settings
+import modules.canvas as Canvas
+import modules.avatar as Avatar
+from modules.profiler import profiler
+
+# Where F4 saves the profiler trace (F3 shows the profiler)
+PROFILER_TRACE_PATH = "profile_trace.json"
+
+# Where Multiplayer connects to (data/server.py serves here by default)
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 24680
+
+# Polled by the main loop, so connecting and playing never blocks a frame
+net_client = NetClient.NetClient()
+
+# Baked avatars, shared by everything that draws one (main() gives it the resource manager)
+avatar_baker = Avatar.AvatarBaker()
 
 def load_assets():
     assets = ResourceManager.Res()
+    # Files get decoded on worker threads, and handed over to 'assets' by loader.poll()
+    loader = ResourceManager.AssetLoader(assets)
     
     # Define directories for images and audio
     image_dir = 'data/textures'
     sound_effects_dir = 'data/sounds'
     music_dir = 'data/soundtrack'
+    asset_pack_path = AssetPack.DEFAULT_PACK_PATH
 
-    # Load images
-    for filename in os.listdir(image_dir):
-        if filename.endswith(('.png', '.jpg', '.jpeg')):
-            image_name = filename.rsplit(".", 1)[0]
-            assets.append(ResourceManager.reference_image(os.path.join(image_dir, filename)), image_name)
-    
-    # Load sound effects
-    for filename in os.listdir(sound_effects_dir):
-        if filename.endswith(('.wav', '.mp3', '.ogg')):
-            sound_name = filename.rsplit(".", 1)[0]
-            assets.append(ResourceManager.reference_audio(os.path.join(sound_effects_dir, filename)), sound_name)
+    pack = None
+    if os.path.exists(asset_pack_path):
+        try:
+            pack = AssetPack.AssetPack(asset_pack_path)
+        except (OSError, ValueError) as error:
+            print(f"Couldn't open '{asset_pack_path}', loading the loose files instead: {error}")
+
+    if pack is not None:
+        # Packed images and sounds (built by modules/assetpack.py), the images need no decoding
+        loader.queue_pack(pack)
+    else:
+        # Load images, the menu needs them before it can show up
+        loader.queue_directory(image_dir, ('.png', '.jpg', '.jpeg'), "images")
+        
+        # Load sound effects, these can finish loading while in the menu
+        loader.queue_directory(sound_effects_dir, ('.wav', '.mp3', '.ogg'), "audio", critical=False)
     
-    # Load music
-    for filename in os.listdir(music_dir):
-        if filename.endswith(('.wav', '.mp3', '.ogg')):
-            music_name = filename.rsplit(".", 1)[0]
-            assets.append(ResourceManager.reference_audio(os.path.join(music_dir, filename)), music_name)
+    # Register music, it's streamed by the music player instead of being loaded
+    if os.path.isdir(music_dir):
+        for filename in sorted(os.listdir(music_dir)):
+            if filename.endswith(('.wav', '.mp3', '.ogg')):
+                assets.append_music(os.path.join(music_dir, filename), filename.rsplit(".", 1)[0])
     
-    return assets
-
-# Function to display loading screen
-def display_loading_screen(screen):
-    font = pygame.font.Font(None, 74)
-    text = font.render('Loading...', True, (255, 255, 255))
-    screen.blit(text, (screen_width // 2 - text.get_width() // 2, screen_height // 2 - text.get_height() // 2))
-    pygame.display.flip()
+    return assets, loader
 
-# Function to scale image without anti-aliasing
-def scale_image(image, scale_factor):
-    width = int(image.get_width() * scale_factor)
-    height = int(image.get_height() * scale_factor)
-    return pygame.transform.scale(image, (width, height))
+# Opens the window for the display settings
+def open_window(settings):
+    if settings.vsync:
+        # vsync only works with a SCALED (or OpenGL) window, SDL scales the canvas up to the window itself then
+        return pygame.display.set_mode(settings.internal_size, pygame.SCALED, vsync=1)
+    return pygame.display.set_mode(settings.window_size)
 
-# Initialize Pygame
-pygame.init()
+# Function to display loading screen, keeps animating (and responding) until the critical assets are loaded
+def display_loading_screen(canvas, loader):
+    screen = canvas.surface
+    font = pygame.font.Font(None, 74)
+    clock = pygame.time.Clock()
+    frame = 0
+    while not loader.critical_loaded:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                loader.shutdown()
+                pygame.quit()
+                quit()
+        progress = loader.poll()
 
-# Set up the display
-screen_width = 800
-screen_height = 600
-state = "mainmenu"
-screen = pygame.display.set_mode((screen_width, screen_height))
-pygame.display.set_caption("RPGOnline")
+        screen.fill((0, 0, 0))
+        text = font.render('Loading' + '.' * (frame // 20 % 4), True, (255, 255, 255))
+        text_x = screen.get_width() // 2 - font.size('Loading...')[0] // 2
+        text_y = screen.get_height() // 2 - text.get_height() // 2
+        screen.blit(text, (text_x, text_y))
 
-# Display loading screen
-display_loading_screen(screen)
+        # Progress bar
+        bar = pygame.Rect(screen.get_width() // 4, text_y + text.get_height() + 20, screen.get_width() // 2, 16)
+        pygame.draw.rect(screen, (255, 255, 255), bar, 2)
+        pygame.draw.rect(screen, (255, 255, 255), (bar.x + 4, bar.y + 4, int((bar.width - 8) * progress), bar.height - 8))
+        pygame.display.update(canvas.present([screen.get_rect()]))
 
-# Load assets
-assets = load_assets()
+        frame += 1
+        clock.tick(60)
 
 # Define button click functions
 def singleplayer_clicked():
@@ -68,88 +103,205 @@ def singleplayer_clicked():
 
 def multiplayer_clicked():
     print("Multiplayer clicked")
+    if net_client.state == "disconnected":
+        print(f"Connecting to {SERVER_HOST}:{SERVER_PORT}")
+        net_client.connect(SERVER_HOST, SERVER_PORT)
 
 def avatar_clicked():
     print("Avatar clicked")
+    # Only composited the first time, after that it comes from the cache until Avatar.json changes
+    avatar = Avatar.Avatar.load()
+    baked = avatar_baker.bake(avatar)
+    print(f"Avatar '{avatar.name}' is {baked.get_width()}x{baked.get_height()}")
 
 def settings_clicked():
     print("Settings clicked")
 
 def exit_clicked():
     print("Exit clicked")
-    pygame.quit()
-    quit()
+    # The main loop quits and cleans up when it sees this
+    pygame.event.post(pygame.event.Event(pygame.QUIT))
 
 # Create UI elements
-main_menu_group = UI.UIGroupStepper((50, 0), (200, screen_height))
-main_menu_background = UI.UIElement((0, 0), (260, screen_height))
-main_menu_background_titler = UI.UIElement((260, 0), (75, 75))
-main_menu_background.image.fill((0, 0, 0, 150))  # Transparent black background
-main_menu_background_titler.image.fill((0, 0, 0, 150))  # Transparent black background
-main_menu_group.add_element(main_menu_background)
-main_menu_group.add_element(main_menu_background_titler)
-
-# Create and add buttons
-buttons = [
-    ("Singleplayer", singleplayer_clicked),
-    ("Multiplayer", multiplayer_clicked),
-    ("Avatar", avatar_clicked),
-    ("Settings", settings_clicked),
-    ("Exit", exit_clicked)
-]
-
-button_height = 50
-spacing = 15
-total_button_height = (button_height + spacing) * len(buttons) - spacing
-start_y = (screen_height - total_button_height) // 2
-
-title = UI.UILabel((10, 10), "RPGONLINE", pygame.font.Font("data\\fonts\\Titles.ttf", 50), (255, 255, 255))
-main_menu_group.add_element(title)
-
-# Adjust the position of buttons
-for text, click_handler in buttons:
-    button = UI.UITextButton(text, pygame.font.Font("data\\fonts\\Body.ttf", 24), (spacing, start_y), 225, button_height, click_handler)
-    main_menu_group.add_element(button)
-    start_y += button_height + spacing
-
-subprocess.Popen(['notepad.exe', 'data/README.txt'])
-
-# Main loop
-running = True
-while running:
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            running = False
-        main_menu_group.handle_event(event)
+def create_main_menu(screen_height):
+    main_menu_group = UI.UIGroupStepper((50, 0), (200, screen_height))
+    main_menu_background = UI.UIElement((0, 0), (260, screen_height))
+    main_menu_background_titler = UI.UIElement((260, 0), (75, 75))
+    main_menu_background.image.fill((0, 0, 0, 150))  # Transparent black background
+    main_menu_background_titler.image.fill((0, 0, 0, 150))  # Transparent black background
+    main_menu_group.add_element(main_menu_background)
+    main_menu_group.add_element(main_menu_background_titler)
+
+    # Create and add buttons
+    buttons = [
+        ("Singleplayer", singleplayer_clicked),
+        ("Multiplayer", multiplayer_clicked),
+        ("Avatar", avatar_clicked),
+        ("Settings", settings_clicked),
+        ("Exit", exit_clicked)
+    ]
+
+    button_height = 50
+    spacing = 15
+
+    title = UI.UILabel((10, 10), "RPGONLINE", ResourceManager.reference_font("data/fonts/Titles.ttf", 50), (255, 255, 255))
+    main_menu_group.add_element(title)
+
+    # The buttons get stacked in the middle of the menu's height by the layout
+    button_stack = main_menu_group.add_layout(UI.UIStackLayout((spacing, 0, 225, screen_height), spacing=spacing, justify="center"))
+    for text, click_handler in buttons:
+        button_stack.add(UI.UITextButton(text, ResourceManager.reference_font("data/fonts/Body.ttf", 24), (0, 0), 225, button_height, click_handler))
+
+    return main_menu_group
+
+# Draws a frame of the main menu, returns the rects of the screen that changed.
+# 'backdrop' is the menu background (white fill + scaled background image) as a [surface, source image] list, it's only rebuilt when the scaled image changes.
+def render_main_menu(screen, assets, main_menu_group, backdrop):
+    screen_width, screen_height = screen.get_size()
+
+    # Drop cached scaled images if the window changed size
+    assets.set_display_size((screen_width, screen_height))
+
+    # Get the background image
+    bg = assets.get('background', 'images', True)
     
-    # Fill the screen with a color (e.g., black)
-        screen.fill((255, 255, 255))
+    # Calculate scaling factors
+    scale_width = screen_width / bg.get_width()
+    scale_height = screen_height / bg.get_height()
     
-    if state == "mainmenu":
-        # Get the background image
-        bg = assets.get('background', 'images', True)
-        
-        # Calculate scaling factors
-        scale_width = screen_width / bg.get_width()
-        scale_height = screen_height / bg.get_height()
-        
-        # Choose the larger scale factor to cover the entire window
-        scale_factor = max(scale_width, scale_height)
-        
-        # Scale the background image
-        bg_scaled = scale_image(bg, scale_factor)
-        
+    # Choose the larger scale factor to cover the entire window
+    scale_factor = max(scale_width, scale_height)
+    
+    # Get the scaled background image (only scaled once, then reused from the cache)
+    bg_scaled = assets.get_scaled('background', (bg.get_width() * scale_factor, bg.get_height() * scale_factor), opaque=True, IgnoreMissing=True)
+    
+    # Build the backdrop with the scaled and centered background image, and redraw the whole screen with it
+    if bg_scaled is not backdrop[1]:
         # Get the rect of the scaled image and center it
         bg_rect = bg_scaled.get_rect()
         bg_rect.center = (screen_width // 2, screen_height // 2)
 
-        # Blit the scaled and centered background image
-        screen.blit(bg_scaled, bg_rect.topleft)
+        backdrop[0] = pygame.Surface((screen_width, screen_height)).convert()
+        backdrop[0].fill((255, 255, 255))
+        backdrop[0].blit(bg_scaled, bg_rect.topleft)
+        backdrop[1] = bg_scaled
+        main_menu_group.invalidate()
 
-        main_menu_group.render_all(screen)
-        
-    # Update the display
-    pygame.display.flip()
+    # Only redraws what changed since the last frame
+    return main_menu_group.render_dirty(screen, backdrop[0])
+
+def main():
+    # Initialize Pygame
+    pygame.init()
+
+    # Read once here, changes made while playing get applied by apply_settings
+    settings = Settings.Settings()
+    settings.load()
+
+    # Set up the display, everything is drawn on the canvas and scaled up to the window
+    state = "mainmenu"
+    canvas = Canvas.Canvas(open_window(settings), settings.internal_size, settings.scale_mode)
+    screen = canvas.surface
+    pygame.display.set_caption("RPGOnline")
+    game_loop = GameLoop.GameLoop(fps_cap=0 if settings.vsync else settings.fps_cap)
+
+    # Start loading assets
+    assets, loader = load_assets()
+    avatar_baker.res = assets
+
+    # Display loading screen
+    display_loading_screen(canvas, loader)
+
+    # Start the soundtrack
+    music = ResourceManager.MusicPlayer(assets, crossfade_ms=2000)
+    music.set_playlist(assets.res["music"], shuffle=True)
+    music.play()
+
+    main_menu_group = create_main_menu(screen.get_height())
+    main_menu_group.set_profile_name("main_menu")
+    menu_backdrop = [None, None]
+    # Where the profiler overlay was drawn last frame
+    overlay_rect = None
+
+    def apply_settings(settings, section, key):
+        nonlocal screen, main_menu_group
+        game_loop.fps_cap = 0 if settings.vsync else settings.fps_cap
+        if section != "Display":
+            return
+        window = open_window(settings) if key in ("vsync", "window_width", "window_height") else canvas.window
+        canvas.configure(window, settings.internal_size, settings.scale_mode)
+        if canvas.surface.get_size() != screen.get_size():
+            # The menu is laid out for the canvas size
+            main_menu_group = create_main_menu(canvas.surface.get_height())
+            main_menu_group.set_profile_name("main_menu")
+        screen = canvas.surface
+        menu_backdrop[:] = [None, None]
+        main_menu_group.invalidate()
+
+    settings.listeners.append(apply_settings)
+
+    subprocess.Popen(['notepad.exe', 'data/README.txt'])
+
+    def handle_events(events):
+        profiler.begin_frame()
+        # Once per frame, never waits
+        with profiler.phase("network"):
+            net_client.poll()
+        with profiler.phase("events"):
+            for event in UI.coalesce_events(events):
+                if event.type == pygame.QUIT:
+                    return False
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                    # Debug overlay, also turns the profiler on and off
+                    profiler.toggle()
+                    main_menu_group.invalidate()
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_F4 and profiler.enabled:
+                    profiler.dump_trace(PROFILER_TRACE_PATH)
+                music.handle_event(event)
+                # The UI works in canvas coordinates
+                main_menu_group.handle_event(canvas.map_event(event))
+
+    def update(dt):
+        with profiler.phase("update"):
+            # The network doesn't wake up the event loop, so stay busy while connected
+            busy = net_client.state != "disconnected"
+
+            # Keep handing over the non-critical assets that are still loading
+            if not loader.finished:
+                loader.poll()
+                busy = True
+            return busy
+
+    def render(alpha):
+        nonlocal overlay_rect
+        # Rects of the canvas that changed this frame
+        dirty_rects = []
+
+        with profiler.phase("render"):
+            if state == "mainmenu":
+                # The overlay gets drawn again on top, but if it shrank the menu has to cover what it left behind
+                if overlay_rect is not None:
+                    main_menu_group.invalidate_rect(overlay_rect)
+                    overlay_rect = None
+                dirty_rects = render_main_menu(screen, assets, main_menu_group, menu_backdrop)
+
+            if profiler.enabled:
+                overlay_rect = profiler.render_overlay(screen, (screen.get_width() - 220, 0))
+                dirty_rects.append(overlay_rect)
+            
+        # Scale the changed parts up to the window, and update them on the display
+        with profiler.phase("display.update"):
+            pygame.display.update(canvas.present(dirty_rects))
+        profiler.end_frame()
+        return dirty_rects
+
+    # Main loop, other code can read game_loop.stats for frame times
+    game_loop.run(handle_events, update, render)
+
+    # Quit Pygame
+    net_client.close()
+    loader.shutdown()
+    pygame.quit()
 
-# Quit Pygame
-pygame.quit()
+if __name__ == "__main__":
+    main()
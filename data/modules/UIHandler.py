@@ -1,12 +1,15 @@
 """The UI Handler for RPGOnline"""
 import colorsys
 import random
+from collections import OrderedDict
 import pygame
 
 if __name__ == "__main__":
-    from resourcemanager import Res, reference_image
+    from resourcemanager import Res, reference_image, reference_font, render_text
+    from profiler import profiler
 else:
-    from modules.resourcemanager import Res, reference_image
+    from modules.resourcemanager import Res, reference_image, reference_font, render_text
+    from modules.profiler import profiler
 
 def rainbow_hsv(hue):
     """
@@ -26,9 +29,29 @@ def rainbow_hsv(hue):
 
     return rgba_color
 
+# Events that have a position and only matter to the elements under it
+POINTER_EVENTS = (pygame.MOUSEMOTION, pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP)
+
+def coalesce_events(events):
+    """
+    Merges every run of back to back MOUSEMOTION events into a single one (with the summed 'rel'), so a burst of motion only gets handled once per frame.
+    Everything else is kept as is and in order.
+    """
+    coalesced = []
+    for event in events:
+        if event.type == pygame.MOUSEMOTION and coalesced and coalesced[-1].type == pygame.MOUSEMOTION:
+            previous = coalesced[-1]
+            merged = dict(event.dict)
+            merged["rel"] = (previous.rel[0] + event.rel[0], previous.rel[1] + event.rel[1])
+            coalesced[-1] = pygame.event.Event(pygame.MOUSEMOTION, merged)
+        else:
+            coalesced.append(event)
+    return coalesced
+
 class UIElement(pygame.sprite.Sprite):
     def __init__(self, position, size, rotation=0):
         super().__init__()
+        profiler.count("surface", 2)
         self.image = pygame.Surface(size, pygame.SRCALPHA)
         self.original_image = self.image.copy()
         self.rect = self.image.get_rect(topleft=position)
@@ -37,6 +60,20 @@ class UIElement(pygame.sprite.Sprite):
         self.selected_color = (0, 0, 0, 0)
         self.current_color = self.default_color
         self.rotation = rotation
+        # Dirty tracking, see UIDirtyRenderer
+        self.dirty = True
+        self.rendered_rect = None
+        # The group this element was added to
+        self.parent = None
+        # The layout placing this element (see UILayout), its options there, and the size it was placed with
+        self.layout = None
+        self.layout_options = {}
+        self.laid_out_size = None
+        # Rotated images by angle, only used after enable_rotation_cache
+        self.rotation_cache = None
+        self.rotation_cache_source = None
+        self.rotation_step = 1
+        self.rotation_cache_size = 0
         self.update_rotation()
 
     def hsva(self, h, s, v, a=255):
@@ -76,12 +113,75 @@ class UIElement(pygame.sprite.Sprite):
         self.rotation = angle
         self.update_rotation()
 
+    def enable_rotation_cache(self, step=1, max_entries=64):
+        """
+        Keeps the last 'max_entries' rotated images around, with the angle rounded to multiples of 'step' degrees, so spinning or wobbling elements stop making a new surface every frame.
+        The cache empties itself when original_image gets replaced.
+        """
+        self.rotation_cache = OrderedDict()
+        self.rotation_cache_source = None
+        self.rotation_step = step
+        self.rotation_cache_size = max_entries
+        self.update_rotation()
+
+    def disable_rotation_cache(self):
+        self.rotation_cache = None
+        self.rotation_cache_source = None
+        self.update_rotation()
+
+    def get_rotated_image(self):
+        if self.rotation_cache is None:
+            profiler.count("transform.rotate")
+            return pygame.transform.rotate(self.original_image, self.rotation)
+
+        if self.rotation_cache_source is not self.original_image:
+            self.rotation_cache.clear()
+            self.rotation_cache_source = self.original_image
+
+        angle = round(self.rotation / self.rotation_step) * self.rotation_step % 360
+        image = self.rotation_cache.get(angle)
+        if image is None:
+            profiler.count("transform.rotate")
+            image = pygame.transform.rotate(self.original_image, angle)
+            self.rotation_cache[angle] = image
+            if len(self.rotation_cache) > self.rotation_cache_size:
+                self.rotation_cache.popitem(last=False)
+        else:
+            self.rotation_cache.move_to_end(angle)
+        return image
+
     def update_rotation(self):
-        self.image = pygame.transform.rotate(self.original_image, self.rotation)
+        old_rect = self.rect
+        old_image = self.image
+        self.image = self.get_rotated_image()
         self.rect = self.image.get_rect(center=self.rect.center)
+        # A cached rotation can give back the very same image, then there's nothing to redraw
+        if self.image is not old_image or self.rect != old_rect:
+            self.dirty = True
+        if self.parent is not None and self.rect != old_rect:
+            self.parent.invalidate_hit_index()
+        # Rotating doesn't change the layout, only a new image size does
+        if self.layout is not None and self.original_image.get_size() != self.laid_out_size:
+            self.layout.invalidate_layout()
+
+    def layout_size(self):
+        """The size layouts make room for, the unrotated one so spinning elements don't push their neighbours around."""
+        return self.original_image.get_size()
+
+    def mark_dirty(self):
+        """Call this after drawing on self.image or self.original_image directly, so dirty rendering and the rotation cache know about it."""
+        self.dirty = True
+        if self.rotation_cache is not None:
+            self.rotation_cache.clear()
 
     def render(self, surface):
-        surface.blit(self.image, self.rect.topleft)
+        surface.blit(*self.draw_command())
+
+    def draw_command(self):
+        """The (image, position) pair render() blits, for Surface.blits. Counts as drawn."""
+        self.rendered_rect = self.rect.copy()
+        self.dirty = False
+        return (self.image, self.rect.topleft)
 
 class UITextButton(UIElement):
     def __init__(self, text, font, position, width, height, on_click,
@@ -89,8 +189,11 @@ class UITextButton(UIElement):
                  hover_color=(150, 150, 150, 0), border_color=(255, 255, 255), border_active_color=(255, 255, 0),
                  border_selected_color=(0, 255, 0)):
         super().__init__(position, (width, height))
-        self.text = text
-        self.font = font
+        # Pre-rendered images for each state ("default", "selected", "active"), built the first time they're needed
+        self.state_images = {}
+        self.state = None
+        self._text = text
+        self._font = font
         self.position = position
         self.width = width
         self.height = height
@@ -112,73 +215,117 @@ class UITextButton(UIElement):
         # Initial rendering
         self.create_image()
 
-    def create_image(self):
-        # Render text
-        text_surface = self.font.render(self.text, True, self.border_color)
-        text_rect = text_surface.get_rect(center=(self.width // 2, self.height // 2))
+    @property
+    def text(self):
+        return self._text
 
-        # Draw button border
-        pygame.draw.rect(self.image, self.border_color, pygame.Rect((0, 0), (self.width, self.height)), self.border_width)
+    @text.setter
+    def text(self, text):
+        if text != self._text:
+            self._text = text
+            self.invalidate_images()
 
-        # Draw text on the button
-        self.image.blit(text_surface, text_rect)
+    @property
+    def font(self):
+        return self._font
 
-        # Set button rectangle
-        self.rect = self.image.get_rect(topleft=self.position)
-        self.original_image = self.image.copy()
-        self.update_rotation()
+    @font.setter
+    def font(self, font):
+        if font is not self._font:
+            self._font = font
+            self.invalidate_images()
 
-    def update_image(self, color, border_color):
-        # Create button surface with the given color
-        if color is not None:
-            self.image.fill(color)
+    def create_image(self):
+        # Set button rectangle
+        self.rect = pygame.Rect(self.position, (self.width, self.height))
+        self.state_images.clear()
+        self.apply_state("default", force=True)
+
+    def build_state_image(self, state):
+        if state == "active":
+            color, border_color = self.active_color, self.border_active_color
+        elif state == "selected":
+            color, border_color = self.selected_color, self.border_selected_color
+        else:
+            color, border_color = self.default_color, self.border_color
+
+        # Create button surface with the state's color
+        profiler.count("surface")
+        image = pygame.Surface((self.width, self.height), pygame.SRCALPHA)
+        image.fill(color)
 
         # Render text
-        if border_color is not None:
-            text_surface = self.font.render(self.text, True, border_color)
-            text_rect = text_surface.get_rect(center=(self.width // 2, self.height // 2))
-
-            # Draw button border
-            pygame.draw.rect(self.image, border_color, pygame.Rect((0, 0), (self.width, self.height)), self.border_width)
+        text_surface = render_text(self.font, self.text, border_color)
+        text_rect = text_surface.get_rect(center=(self.width // 2, self.height // 2))
 
-            # Draw text on the button
-            self.image.blit(text_surface, text_rect)
+        # Draw button border
+        pygame.draw.rect(image, border_color, pygame.Rect((0, 0), (self.width, self.height)), self.border_width)
 
-        self.original_image = self.image.copy()
+        # Draw text on the button
+        image.blit(text_surface, text_rect)
+        return image
+
+    def invalidate_images(self):
+        """
+        Throws away the pre-rendered state images after the text, font or colors changed. Only the current state gets rebuilt right away, the rest are rebuilt when they're used.
+        """
+        self.state_images.clear()
+        if self.state is not None:
+            self.apply_state(self.state, force=True)
+
+    def apply_state(self, state, force=False):
+        # Nothing to do if the button already looks like this
+        if state == self.state and not force:
+            return
+        image = self.state_images.get(state)
+        if image is None:
+            image = self.build_state_image(state)
+            self.state_images[state] = image
+        self.state = state
+        if state == "active":
+            self.current_color = self.active_color
+        elif state == "selected":
+            self.current_color = self.selected_color
+        else:
+            self.current_color = self.default_color
+        # The state images are never drawn on, update_rotation always makes a new self.image from them
+        self.original_image = image
         self.update_rotation()
 
     def set_active(self):
-        super().set_active()
-        self.update_image(self.active_color, self.border_active_color)
+        self.apply_state("active")
         self.selected = True
 
     def set_selected(self):
-        super().set_selected()
-        self.update_image(self.selected_color, self.border_selected_color)
+        self.apply_state("selected")
         self.selected = True
 
     def set_default(self):
-        super().set_default()
-        self.update_image(self.default_color, self.border_color)
+        self.apply_state("default")
         self.selected = False
 
-    def render(self, surface):
-        super().render(surface)
-    
     def set_colors(self, default_color = None, active_color = None, selected_color = None, default_border_color = None, active_border_color = None, selected_border_color = None,):
-        if default_color != None:
+        changed = False
+        if default_color != None and default_color != self.default_color:
             self.default_color = default_color
-        if active_color != None:
+            changed = True
+        if active_color != None and active_color != self.active_color:
             self.active_color = active_color
-        if selected_color != None:
+            changed = True
+        if selected_color != None and selected_color != self.selected_color:
             self.selected_color = selected_color
-        if default_border_color != None:
+            changed = True
+        if default_border_color != None and default_border_color != self.border_color:
             self.border_color = default_border_color
-        if active_border_color != None:
+            changed = True
+        if active_border_color != None and active_border_color != self.border_active_color:
             self.border_active_color = active_border_color
-        if selected_border_color != None:
+            changed = True
+        if selected_border_color != None and selected_border_color != self.border_selected_color:
             self.border_selected_color = selected_border_color
-        self.update_image(self.default_color if default_color != None else None, self.border_color if default_border_color != None else None)
+            changed = True
+        if changed:
+            self.invalidate_images()
 
     def handle_event(self, event):
         if event.type == pygame.MOUSEMOTION:
@@ -219,7 +366,7 @@ class UIImageButton(UIElement):
 
 class UILabel(UIElement):
     def __init__(self, position, text, font, color):
-        text_surface = font.render(text, True, color)
+        text_surface = render_text(font, text, color)
         size = text_surface.get_size()
         super().__init__(position, size)
         self.text = text
@@ -228,22 +375,31 @@ class UILabel(UIElement):
         self.render_text()
 
     def render_text(self):
-        self.image = self.font.render(self.text, True, self.color)
-        self.original_image = self.image.copy()
-        self.rect = self.image.get_rect(topleft=self.rect.topleft)
+        # Shared with the text cache, update_rotation makes self.image a new surface from it
+        self.original_image = render_text(self.font, self.text, self.color)
+        self.rect = self.original_image.get_rect(topleft=self.rect.topleft)
         self.update_rotation()
 
 class UIImage(UIElement):
     def __init__(self, position, image_id, res_manager):
-        image = res_manager.get(image_id, "images", IgnoreMissing=True)
+        # Held until the element is killed, so the resource manager doesn't evict it
+        image = res_manager.acquire(image_id, "images", IgnoreMissing=True)
         size = image.get_size()
         super().__init__(position, size)
         self.res_manager = res_manager
+        self.image_id = image_id
         self.image = image
-        self.original_image = self.image.copy()
+        # Shared with the resource manager, update_rotation makes self.image a new surface from it
+        self.original_image = image
         self.rect = self.image.get_rect(topleft=position)
         self.update_rotation()
 
+    def kill(self):
+        if self.res_manager is not None:
+            self.res_manager.release(self.image_id, "images")
+            self.res_manager = None
+        super().kill()
+
 class UIAlignmentHandler:
     @staticmethod
     def align_center_x(element, container_rect):
@@ -257,65 +413,470 @@ class UIAlignmentHandler:
     def align_center(element, container_rect):
         element.rect.center = container_rect.center
 
-class UIListHandler:
+def render_batch(surface, elements):
+    """
+    Draws 'elements' in order with as few Surface.blits calls as possible, the Python overhead of one blit call per element adds up with lots of small sprites.
+    Elements that override render() with their own drawing still get it called, in their place.
+    """
+    blits = []
+    for element in elements:
+        if type(element).render is UIElement.render:
+            blits.append(element.draw_command())
+        else:
+            if blits:
+                profiler.count("blits")
+                surface.blits(blits, doreturn=False)
+                blits = []
+            element.render(surface)
+    if blits:
+        profiler.count("blits")
+        surface.blits(blits, doreturn=False)
+
+class UILayout:
+    """
+    Base of the layout containers. A layout places its children (elements or other layouts) inside its rect.
+    Adding, removing or resizing a child only marks its layout and the layouts above it as dirty, the group places them again in update_layout, once per frame before drawing (and before routing events). Layouts that didn't change are skipped.
+    A layout made without a size takes the size its children need, one made with a size keeps it. Layouts inside other layouts get moved by them.
+    Elements are placed by their unrotated size and centered on their slot, so rotating them doesn't move anything.
+    """
+    def __init__(self, rect=None, padding=0):
+        self.rect = pygame.Rect(rect) if rect is not None else pygame.Rect(0, 0, 0, 0)
+        self.fixed_size = rect is not None and self.rect.width > 0 and self.rect.height > 0
+        self.padding = padding
+        self.children = []
+        self.layout = None
+        self.layout_options = {}
+        self.layout_dirty = True
+        # Set on the outermost layout by UIDirtyRenderer.add_layout
+        self.group = None
+
+    def root(self):
+        layout = self
+        while layout.layout is not None:
+            layout = layout.layout
+        return layout
+
+    def elements(self):
+        """Every element in this layout and the layouts inside it, in order."""
+        for child in self.children:
+            if isinstance(child, UILayout):
+                yield from child.elements()
+            else:
+                yield child
+
+    def add(self, child, **options):
+        """Adds an element or a layout, with options for this kind of layout. The elements also get added to the group the layout is in."""
+        child.layout = self
+        child.layout_options = options
+        self.children.append(child)
+        group = self.root().group
+        if group is not None:
+            for element in (child.elements() if isinstance(child, UILayout) else (child,)):
+                if element not in group.elements:
+                    group.add_element(element)
+        self.invalidate_layout()
+        return child
+
+    def remove(self, child):
+        self.children.remove(child)
+        child.layout = None
+        self.invalidate_layout()
+
+    def invalidate_layout(self):
+        # Every layout above a dirty one is dirty already, so this stops early
+        layout = self
+        while layout is not None and not layout.layout_dirty:
+            layout.layout_dirty = True
+            layout = layout.layout
+
+    def child_size(self, child):
+        if isinstance(child, UILayout):
+            return child.preferred_size()
+        return child.layout_size()
+
+    def preferred_size(self):
+        if self.fixed_size:
+            return self.rect.size
+        width, height = self.content_size()
+        return (width + self.padding * 2, height + self.padding * 2)
+
+    def content_size(self):
+        return (0, 0)
+
+    def place(self, child, slot):
+        """Puts a child in the slot rect the layout picked for it."""
+        if isinstance(child, UILayout):
+            if child.rect != slot:
+                child.rect = pygame.Rect(slot)
+                child.layout_dirty = True
+            return
+        size = child.layout_size()
+        child.laid_out_size = size
+        center = (slot[0] + size[0] // 2, slot[1] + size[1] // 2)
+        if child.rect.center != center:
+            child.rect.center = center
+            if child.parent is not None:
+                child.parent.invalidate_hit_index()
+
+    def update(self):
+        """Places the children again if something changed, then updates the layouts inside it."""
+        if not self.layout_dirty:
+            return
+        self.layout_dirty = False
+        if not self.fixed_size and self.layout is None:
+            self.rect.size = self.preferred_size()
+        self.arrange(self.rect.inflate(-self.padding * 2, -self.padding * 2))
+        for child in self.children:
+            if isinstance(child, UILayout):
+                child.update()
+
+    def arrange(self, area):
+        pass
+
+class UIStackLayout(UILayout):
+    """
+    Children one after the other, top to bottom ("vertical") or left to right ("horizontal"), 'spacing' pixels apart.
+    'align' puts them at the "start", "center" or "end" of the other axis, 'justify' does the same for the whole stack along its axis.
+    """
+    def __init__(self, rect=None, direction="vertical", spacing=10, align="start", justify="start", padding=0):
+        super().__init__(rect, padding)
+        self.direction = direction
+        self.spacing = spacing
+        self.align = align
+        self.justify = justify
+
+    def content_size(self):
+        sizes = [self.child_size(child) for child in self.children]
+        if not sizes:
+            return (0, 0)
+        axis = 1 if self.direction == "vertical" else 0
+        length = sum(size[axis] for size in sizes) + self.spacing * (len(sizes) - 1)
+        across = max(size[1 - axis] for size in sizes)
+        return (across, length) if axis == 1 else (length, across)
+
+    def arrange(self, area):
+        axis = 1 if self.direction == "vertical" else 0
+        area_start = (area.x, area.y)
+        area_size = area.size
+        length = self.content_size()[axis]
+        offset = {"center": (area_size[axis] - length) // 2, "end": area_size[axis] - length}.get(self.justify, 0)
+        for child in self.children:
+            size = self.child_size(child)
+            align = child.layout_options.get("align", self.align)
+            across = {"center": (area_size[1 - axis] - size[1 - axis]) // 2, "end": area_size[1 - axis] - size[1 - axis]}.get(align, 0)
+            if axis == 1:
+                self.place(child, (area_start[0] + across, area_start[1] + offset, size[0], size[1]))
+            else:
+                self.place(child, (area_start[0] + offset, area_start[1] + across, size[0], size[1]))
+            offset += size[axis] + self.spacing
+
+class UIGridLayout(UILayout):
+    """
+    Children in rows of 'columns' cells, filled left to right. Every cell is 'cell_size', or as big as the biggest child if it's None, and children are centered in their cell.
+    """
+    def __init__(self, rect=None, columns=4, cell_size=None, spacing=(10, 10), padding=0):
+        super().__init__(rect, padding)
+        self.columns = max(columns, 1)
+        self.cell_size = cell_size
+        self.spacing = spacing
+
+    def get_cell_size(self):
+        if self.cell_size is not None:
+            return self.cell_size
+        sizes = [self.child_size(child) for child in self.children]
+        return (max((size[0] for size in sizes), default=0), max((size[1] for size in sizes), default=0))
+
+    def content_size(self):
+        if not self.children:
+            return (0, 0)
+        cell_width, cell_height = self.get_cell_size()
+        columns = min(self.columns, len(self.children))
+        rows = (len(self.children) + self.columns - 1) // self.columns
+        return (columns * cell_width + (columns - 1) * self.spacing[0], rows * cell_height + (rows - 1) * self.spacing[1])
+
+    def arrange(self, area):
+        cell_width, cell_height = self.get_cell_size()
+        for index, child in enumerate(self.children):
+            column, row = index % self.columns, index // self.columns
+            width, height = self.child_size(child)
+            x = area.x + column * (cell_width + self.spacing[0]) + (cell_width - width) // 2
+            y = area.y + row * (cell_height + self.spacing[1]) + (cell_height - height) // 2
+            self.place(child, (x, y, width, height))
+
+class UIAnchorLayout(UILayout):
+    """
+    Pins each child to a point of the layout's rect: add(child, anchor="bottomright", offset=(-10, -10)).
+    Anchors are pygame.Rect point names ("topleft", "midtop", "center", ...), the same point of the child goes there. Children don't affect each other, so only the one that changed really moves.
+    """
+    def content_size(self):
+        sizes = [self.child_size(child) for child in self.children]
+        return (max((size[0] for size in sizes), default=0), max((size[1] for size in sizes), default=0))
+
+    def arrange(self, area):
+        for child in self.children:
+            anchor = child.layout_options.get("anchor", "topleft")
+            offset = child.layout_options.get("offset", (0, 0))
+            slot = pygame.Rect((0, 0), self.child_size(child))
+            point = getattr(area, anchor)
+            setattr(slot, anchor, (point[0] + offset[0], point[1] + offset[1]))
+            self.place(child, slot)
+
+class UIDirtyRenderer:
+    """
+    Retained-mode rendering for element groups.
+    Instead of redrawing everything every frame, render_dirty only redraws the areas where an element changed its image, rect or rotation since it was last drawn, and returns those rects for pygame.display.update.
+    """
+    def invalidate(self):
+        """Makes the next render_dirty redraw the whole surface, for the first frame or after switching screens."""
+        self.full_redraw = True
+
+    def invalidate_rect(self, rect):
+        """Makes the next render_dirty redraw 'rect', for things drawn over the group (or removed from it) that it can't see."""
+        self.damage.append(pygame.Rect(rect))
+
+    def set_profile_name(self, name):
+        """The name the group shows up as in the profiler (see profiler.py). The phase names are built here, not on every frame and event."""
+        self.profile_name = name
+        self.render_phase = f"render {name}"
+        self.event_phase = f"handle_event {name}"
+
+    def remove_element(self, element):
+        """
+        Takes an element out of the group (and out of its layout), redraws where it was, and kills it.
+        Killing releases whatever the element holds, like the image of a UIImage, so don't add it anywhere again.
+        """
+        self.elements.remove(element)
+        element.parent = None
+        if element.layout is not None:
+            element.layout.remove(element)
+        if element.rendered_rect is not None:
+            self.invalidate_rect(element.rendered_rect)
+        self.invalidate_hit_index()
+        element.kill()
+
+    def add_layout(self, layout):
+        """Lets a UILayout place elements of this group. Its elements get added to the group (if they aren't in it yet)."""
+        layout.group = self
+        self.layouts.append(layout)
+        for element in layout.elements():
+            if element not in self.elements:
+                self.add_element(element)
+        layout.invalidate_layout()
+        return layout
+
+    def update_layout(self):
+        """Places the elements of the layouts that changed, it's cheap when nothing did."""
+        for layout in self.layouts:
+            layout.update()
+
+    def collect_damage(self):
+        rects = self.damage
+        self.damage = []
+        for element in self.elements:
+            if element.dirty or element.rect != element.rendered_rect:
+                # Both where it was and where it is now need to be redrawn
+                if element.rendered_rect is not None:
+                    rects.append(element.rendered_rect)
+                rects.append(element.rect.copy())
+        return rects
+
+    def render_dirty(self, surface, background=(0, 0, 0)):
+        """
+        Redraws the damaged areas of 'surface' and returns the list of rects that changed.
+        'background' is either a color, or a surface the same size as 'surface' that gets drawn behind the elements.
+        """
+        with profiler.phase(self.render_phase):
+            self.update_layout()
+            return self.redraw_damage(surface, background)
+
+    def redraw_damage(self, surface, background):
+        if self.full_redraw:
+            self.full_redraw = False
+            rects = [surface.get_rect()]
+        else:
+            rects = self.collect_damage()
+            if not rects:
+                return rects
+
+            # Merge overlapping rects so nothing gets drawn twice
+            merged = []
+            for rect in rects:
+                index = rect.collidelist(merged)
+                while index != -1:
+                    rect = rect.union(merged.pop(index))
+                    index = rect.collidelist(merged)
+                merged.append(rect)
+            rects = [rect.clip(surface.get_rect()) for rect in merged]
+
+        old_clip = surface.get_clip()
+        for rect in rects:
+            surface.set_clip(rect)
+            if isinstance(background, pygame.Surface):
+                surface.blit(background, rect, rect)
+            else:
+                surface.fill(background, rect)
+            render_batch(surface, [element for element in self.elements if element.rect.colliderect(rect)])
+        surface.set_clip(old_clip)
+        return rects
+
+class UISpatialGrid:
+    """
+    A uniform grid over element rects, used to find the elements under a point without checking all of them.
+    """
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.rects = {}
+        self.order = {}
+
+    def rebuild(self, elements):
+        self.cells.clear()
+        self.rects.clear()
+        self.order.clear()
+        for element in elements:
+            self.insert(element)
+
+    def insert(self, element):
+        rect = element.rect.copy()
+        self.rects[element] = rect
+        self.order[element] = len(self.order)
+        for cell_x in range(rect.left // self.cell_size, (rect.right - 1) // self.cell_size + 1):
+            for cell_y in range(rect.top // self.cell_size, (rect.bottom - 1) // self.cell_size + 1):
+                self.cells.setdefault((cell_x, cell_y), []).append(element)
+
+    def query_point(self, pos):
+        cell = self.cells.get((pos[0] // self.cell_size, pos[1] // self.cell_size), ())
+        return [element for element in cell if element.rect.collidepoint(pos)]
+
+class UIEventRouter:
+    """
+    Event handling for element groups.
+    Pointer events only go to the elements under the cursor, plus the ones that were under it last time (so they can un-hover), found through a UISpatialGrid.
+    Any other event goes to every element that handles events.
+    """
+    def invalidate_hit_index(self):
+        """Elements call this when their rect changes. Rects moved around directly (like UIAlignmentHandler does) get noticed by refresh_hit_index too."""
+        self.hit_index_dirty = True
+
+    def hit_index_stale(self):
+        # Comparing the rects is a lot cheaper than calling handle_event on every element, and catches rects changed behind the group's back
+        return any(element.rect != rect for element, rect in self.hit_index.rects.items())
+
+    def refresh_hit_index(self):
+        if self.hit_index_dirty or len(self.elements) != self.indexed_count or self.hit_index_stale():
+            self.hit_index_dirty = False
+            self.indexed_count = len(self.elements)
+            self.handlers = [element for element in self.elements if hasattr(element, 'handle_event')]
+            self.hit_index.rebuild(self.handlers)
+            self.hovered = [element for element in self.hovered if element in self.hit_index.rects]
+
+    def handle_event(self, event):
+        with profiler.phase(self.event_phase):
+            self.route_event(event)
+
+    def route_event(self, event):
+        # Elements have to be where they're drawn before anything gets hit
+        self.update_layout()
+        self.refresh_hit_index()
+        if event.type in POINTER_EVENTS:
+            under = self.hit_index.query_point(event.pos)
+            targets = under + [element for element in self.hovered if element not in under]
+            targets.sort(key=self.hit_index.order.get)
+            self.hovered = under
+            for element in targets:
+                element.handle_event(event)
+        else:
+            for element in self.handlers:
+                element.handle_event(event)
+
+class UIListHandler(UIDirtyRenderer, UIEventRouter):
     def __init__(self, elements=None):
         self.elements = elements or []
         self.spacing = 10
         self.alignment = "left"  # Default alignment
+        # Made by align_elements
+        self.list_layout = None
+        self.full_redraw = False
+        # Rects to redraw next frame besides the ones elements changed, see invalidate_rect
+        self.damage = []
+        self.set_profile_name(type(self).__name__)
+        # Event routing, see UIEventRouter
+        self.hit_index = UISpatialGrid()
+        self.hit_index_dirty = True
+        self.indexed_count = 0
+        self.handlers = []
+        self.hovered = []
+        # Layouts placing the elements, see UILayout
+        self.layouts = []
+        for element in self.elements:
+            element.parent = self
 
     def add_element(self, element):
         self.elements.append(element)
+        element.parent = self
+        self.invalidate_hit_index()
+        if self.list_layout is not None and element.layout is None:
+            self.list_layout.add(element)
 
     def set_spacing(self, spacing):
         self.spacing = spacing
+        if self.list_layout is not None:
+            self.list_layout.spacing = spacing
+            self.list_layout.invalidate_layout()
 
     def set_alignment(self, alignment):
         self.alignment = alignment
 
     def align_elements(self, container_rect):
-        total_height = sum(element.rect.height + self.spacing for element in self.elements)
-        if self.alignment == "left":
-            current_y = container_rect.top
+        """
+        Stacks the elements top to bottom in 'container_rect', on its left, center or right depending on the alignment (right aligned ones also sit at the bottom).
+        It's a UIStackLayout, so after this the elements stay stacked when they change size or new ones get added.
+        """
+        align = {"center": "center", "right": "end"}.get(self.alignment, "start")
+        if self.list_layout is None:
+            self.list_layout = UIStackLayout(container_rect, spacing=self.spacing)
             for element in self.elements:
-                element.rect.topleft = (container_rect.left, current_y)
-                current_y += element.rect.height + self.spacing
-        elif self.alignment == "center":
-            current_y = container_rect.centery - total_height // 2
-            for element in self.elements:
-                element.rect.centerx = container_rect.centerx
-                element.rect.top = current_y
-                current_y += element.rect.height + self.spacing
-        elif self.alignment == "right":
-            current_y = container_rect.bottom - total_height
-            for element in self.elements:
-                element.rect.bottomright = (container_rect.right, current_y)
-                current_y += element.rect.height + self.spacing
+                self.list_layout.add(element)
+            self.add_layout(self.list_layout)
+        self.list_layout.rect = pygame.Rect(container_rect)
+        self.list_layout.fixed_size = True
+        self.list_layout.align = align
+        self.list_layout.justify = align
+        self.list_layout.invalidate_layout()
 
     def render_all(self, surface):
-        for element in self.elements:
-            element.render(surface)
-
-    def handle_event(self, event):
-        for element in self.elements:
-            if hasattr(element, 'handle_event'):
-                element.handle_event(event)
+        with profiler.phase(self.render_phase):
+            self.update_layout()
+            render_batch(surface, self.elements)
 
-class UIGroupStepper(UIElement):
+class UIGroupStepper(UIElement, UIDirtyRenderer, UIEventRouter):
     def __init__(self, position, size, elements=None):
         super().__init__(position, size)
         self.elements = elements or []
+        self.full_redraw = False
+        # Rects to redraw next frame besides the ones elements changed, see invalidate_rect
+        self.damage = []
+        self.set_profile_name(type(self).__name__)
+        # Event routing, see UIEventRouter
+        self.hit_index = UISpatialGrid()
+        self.hit_index_dirty = True
+        self.indexed_count = 0
+        self.handlers = []
+        self.hovered = []
+        # Layouts placing the elements, see UILayout
+        self.layouts = []
+        for element in self.elements:
+            element.parent = self
 
     def add_element(self, element):
         self.elements.append(element)
+        element.parent = self
+        self.invalidate_hit_index()
 
     def render_all(self, surface):
-        for element in self.elements:
-            element.render(surface)
-
-    def handle_event(self, event):
-        for element in self.elements:
-            if hasattr(element, 'handle_event'):
-                element.handle_event(event)
+        with profiler.phase(self.render_phase):
+            self.update_layout()
+            render_batch(surface, self.elements)
 
 
 
@@ -340,8 +901,9 @@ if __name__ == "__main__":
     image = UIImage((450, 200), "fwog", res_manager)
     label1 = UILabel((100, 100), "UIEngine!", pygame.font.SysFont("comicsansms", 36), (255, 255, 255))
     label2 = UILabel((100, 160), "Spin", pygame.font.SysFont("comicsansms", 36), (127, 255, 127))
-    button = UITextButton("A button that does nothing.", pygame.font.Font("data/fonts/Body.ttf", 18),(100, 300), 250, 50, button_clicked,default_color=(0, 0, 0),active_color=(100, 100, 100),selected_color=(0, 0, 0),border_color=(255, 255, 255),border_active_color=(0, 255, 0),border_selected_color=(0, 200, 0))
-    button2 = UITextButton("Frog.", pygame.font.Font("data/fonts/Body.ttf", 18),(100, 375), 250, 50, button_clicked2)
+    label2.enable_rotation_cache(step=3, max_entries=120)
+    button = UITextButton("A button that does nothing.", reference_font("data/fonts/Body.ttf", 18),(100, 300), 250, 50, button_clicked,default_color=(0, 0, 0),active_color=(100, 100, 100),selected_color=(0, 0, 0),border_color=(255, 255, 255),border_active_color=(0, 255, 0),border_selected_color=(0, 200, 0))
+    button2 = UITextButton("Frog.", reference_font("data/fonts/Body.ttf", 18),(100, 375), 250, 50, button_clicked2)
     group_stepper = UIGroupStepper((0, 0), (800, 600))
     group_stepper.add_element(image)
     group_stepper.add_element(label1)
@@ -355,8 +917,7 @@ if __name__ == "__main__":
 
     running = True
     while running:
-        screen.fill((0, 0, 0))
-        for event in pygame.event.get():
+        for event in coalesce_events(pygame.event.get()):
             if event.type == pygame.QUIT:
                 running = False
             group_stepper.handle_event(event)
@@ -365,10 +926,11 @@ if __name__ == "__main__":
         i += 1
         label2.set_rotation(i)
         button2.set_colors(None, None, None, rainbow_hsv(i), rainbow_hsv(i), rainbow_hsv(i))
-        group_stepper.render_all(screen)
-        button_row.render_all(screen)
+        # Only the spinning label and the rainbow button get redrawn
+        rects = group_stepper.render_dirty(screen, (0, 0, 0))
+        rects += button_row.render_dirty(screen, (0, 0, 0))
 
-        pygame.display.flip()
+        pygame.display.update(rects)
         clock.tick(60)
 
     pygame.quit()
@@ -0,0 +1,172 @@
+"""
+Packed asset archives for RPGOnline.
+
+Instead of finding and decoding every loose PNG/OGG on launch, the packer builds a single indexed file (data/assets.pak by default):
+ - Images are stored as raw 32-bit pixels in the layout the display uses, so loading one is a copy instead of a PNG decode.
+ - Sounds are stored as their original files, as pygame decodes them from memory just as well.
+The game memory-maps the archive and builds surfaces straight from it. If there's no archive, it loads the loose files like before, so nothing changes while developing.
+Loose files that were added or edited after the archive was built win over the packed ones (with a message saying to rebuild it), so a stale archive never hides a change.
+
+Run this file from the game folder to (re)build the archive:
+    python data/modules/assetpack.py
+"""
+
+import hashlib
+import io
+import json
+import mmap
+import os
+import struct
+import sys
+import pygame
+
+MAGIC = b"RPGPAK\x00\x01"
+HEADER = struct.Struct("<8sI")
+ALIGNMENT = 16
+# Byte order of 32-bit display surfaces with alpha on little-endian machines (SDL's ARGB8888), so convert_alpha() is a plain copy
+PIXEL_FORMAT = "BGRA"
+
+DEFAULT_PACK_PATH = "data/assets.pak"
+DEFAULT_SOURCES = [
+    ("data/textures", "images", (".png", ".jpg", ".jpeg")),
+    ("data/sounds", "audio", (".wav", ".mp3", ".ogg")),
+]
+
+def pack_assets(output_path:str = DEFAULT_PACK_PATH, sources:list = DEFAULT_SOURCES):
+    """
+    Builds an archive out of every file in 'sources', a list of (directory, type, extensions).
+    Returns the number of packed assets.
+    """
+    index = []
+    blobs = []
+    for directory, elementtype, extensions in sources:
+        if not os.path.isdir(directory):
+            print(f"Missing asset directory '{directory}'")
+            continue
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(extensions):
+                continue
+            path = os.path.join(directory, filename)
+            with open(path, "rb") as file:
+                source = file.read()
+            stat = os.stat(path)
+            entry = {
+                "id": filename.rsplit(".", 1)[0],
+                "type": elementtype,
+                "hash": hashlib.sha256(source).hexdigest(),
+                # To tell if the loose file changed without hashing it again
+                "source_size": stat.st_size,
+                "source_mtime": stat.st_mtime_ns,
+            }
+            if elementtype == "images":
+                image = pygame.image.load(io.BytesIO(source), filename)
+                data = pygame.image.tobytes(image, PIXEL_FORMAT)
+                entry["size"] = list(image.get_size())
+                entry["format"] = PIXEL_FORMAT
+            else:
+                data = source
+                entry["extension"] = filename.rsplit(".", 1)[1]
+            index.append(entry)
+            blobs.append(data)
+
+    # Offsets are relative to the start of the data, which comes right after the (aligned) index
+    position = 0
+    for entry, data in zip(index, blobs):
+        entry["offset"] = position
+        entry["length"] = len(data)
+        position = align(position + len(data))
+    index_bytes = json.dumps(index).encode("utf-8")
+    data_start = align(HEADER.size + len(index_bytes))
+
+    temporary_path = output_path + ".tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, len(index_bytes)))
+        file.write(index_bytes)
+        for entry, data in zip(index, blobs):
+            file.write(b"\0" * (data_start + entry["offset"] - file.tell()))
+            file.write(data)
+    os.replace(temporary_path, output_path)
+    print(f"Packed {len(index)} assets into '{output_path}'.")
+    return len(index)
+
+def align(position:int):
+    return (position + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+class AssetPack():
+    """
+    A memory-mapped archive made by pack_assets. decode() only reads the bytes of the asset it's asked for, and is safe to call from worker threads.
+    Keep the pack open while its assets are still being loaded.
+    """
+    def __init__(self, path:str = DEFAULT_PACK_PATH) -> None:
+        self.path = path
+        self.file = open(path, "rb")
+        self.data = None
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, index_length = HEADER.unpack_from(self.data, 0)
+            if magic != MAGIC:
+                raise ValueError("wrong magic number")
+            index = json.loads(self.data[HEADER.size:HEADER.size + index_length].decode("utf-8"))
+            self.entries = {(entry["id"], entry["type"]): entry for entry in index}
+        except (ValueError, struct.error, KeyError, TypeError) as error:
+            # Empty, truncated or not a pack at all
+            self.close()
+            raise ValueError(f"'{path}' isn't a valid RPGOnline asset pack ({error}), rebuild it with: python data/modules/assetpack.py")
+        self.data_start = align(HEADER.size + index_length)
+
+    def list(self):
+        return list(self.entries)
+
+    def find_loose_changes(self, sources:list = DEFAULT_SOURCES):
+        """
+        Returns the loose files in 'sources' that the pack doesn't have, or has another version of, as (path, id, type).
+        Files with the same size and modification time as when they were packed are trusted, only the others get hashed.
+        """
+        changed = []
+        for directory, elementtype, extensions in sources:
+            if not os.path.isdir(directory):
+                continue
+            for filename in sorted(os.listdir(directory)):
+                if not filename.endswith(extensions):
+                    continue
+                path = os.path.join(directory, filename)
+                id = filename.rsplit(".", 1)[0]
+                entry = self.entries.get((id, elementtype))
+                if entry is None:
+                    changed.append((path, id, elementtype))
+                    continue
+                stat = os.stat(path)
+                if stat.st_size == entry.get("source_size") and stat.st_mtime_ns == entry.get("source_mtime"):
+                    continue
+                with open(path, "rb") as file:
+                    if hashlib.sha256(file.read()).hexdigest() != entry["hash"]:
+                        changed.append((path, id, elementtype))
+        if changed:
+            print(f"{len(changed)} assets changed since '{self.path}' was built, loading them from the loose files. Rebuild it with: python data/modules/assetpack.py")
+        return changed
+
+    def read(self, id:str, elementtype:str):
+        entry = self.entries[(id, elementtype)]
+        start = self.data_start + entry["offset"]
+        return memoryview(self.data)[start:start + entry["length"]]
+
+    def decode(self, id:str, elementtype:str):
+        """
+        Returns a surface or a sound. The surface is a view of the pack's bytes, convert it (on the main thread) before keeping it, that's the only copy it gets.
+        """
+        entry = self.entries[(id, elementtype)]
+        data = self.read(id, elementtype)
+        if elementtype == "images":
+            # No copy, the view keeps the mmap open until the surface is gone
+            return pygame.image.frombuffer(data, tuple(entry["size"]), entry["format"])
+        elif elementtype == "audio":
+            return pygame.mixer.Sound(file=io.BytesIO(data))
+        return None
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+        self.file.close()
+
+if __name__ == "__main__":
+    pack_assets(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PACK_PATH)
@@ -0,0 +1,166 @@
+"""
+Avatars for RPGOnline.
+
+An avatar is a stack of layers (body, clothes, ...) described in data/Avatar.json, each one an image from the resource manager with a tint, a hue shift, or a rainbow color.
+Compositing tinted layers every frame for every player on screen would be way too slow, so AvatarBaker composites each avatar once per pose into a single surface, and keeps it until the definition changes.
+"""
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+import numpy as np
+import pygame
+
+try:
+    from modules.UIHandler import rainbow_hsv
+    from modules.profiler import profiler
+except ImportError:
+    from UIHandler import rainbow_hsv
+    from profiler import profiler
+
+DEFAULT_AVATAR_PATH = "data/Avatar.json"
+
+DEFAULT_AVATAR = {
+    "name": "Player",
+    # Bottom to top. "tint" multiplies the colors, "hue_shift" turns the hue by that many degrees, "rainbow" tints with rainbow_hsv at the hue the avatar is baked with
+    "layers": [
+        {"part": "body", "image": "fwog", "tint": [255, 255, 255], "hue_shift": 0, "rainbow": False, "offset": [0, 0]},
+    ],
+    # Per pose: "flip" mirrors the avatar, "offsets" moves parts, "hidden" leaves parts out
+    "poses": {
+        "idle": {},
+        "left": {"flip": True},
+    },
+}
+
+def definition_hash(definition:dict):
+    """Same definition, same hash, whatever order the keys are in."""
+    return hashlib.sha1(json.dumps(definition, sort_keys=True).encode("utf-8")).hexdigest()
+
+def hue_rotation_matrix(degrees:float):
+    """A matrix that turns RGB colors around the gray axis, the same as shifting their hue."""
+    angle = np.radians(degrees)
+    cos, sin = np.cos(angle), np.sin(angle)
+    third = (1 - cos) / 3
+    root = np.sqrt(1 / 3) * sin
+    return np.array([
+        [cos + third, third - root, third + root],
+        [third + root, cos + third, third - root],
+        [third - root, third + root, cos + third],
+    ], np.float32)
+
+def shift_hue(surface, degrees:float):
+    """Shifts the hue of 'surface' in place, alpha stays as it is."""
+    pixels = pygame.surfarray.pixels3d(surface)
+    shifted = pixels.reshape(-1, 3).astype(np.float32) @ hue_rotation_matrix(degrees).T
+    pixels[...] = np.clip(shifted, 0, 255).astype(np.uint8).reshape(pixels.shape)
+    # Unlocks the surface
+    del pixels
+
+class Avatar():
+    """
+    An avatar definition. 'key' is the hash of the definition, change it with set_definition (or call changed() after editing 'definition' directly) so baked surfaces get rebuilt.
+    """
+    def __init__(self, definition:dict = None) -> None:
+        self.set_definition(definition if definition is not None else json.loads(json.dumps(DEFAULT_AVATAR)))
+
+    def set_definition(self, definition:dict):
+        self.definition = definition
+        self.changed()
+
+    def changed(self):
+        self.key = definition_hash(self.definition)
+
+    @property
+    def name(self):
+        return self.definition.get("name", "Player")
+
+    @classmethod
+    def load(cls, path:str = DEFAULT_AVATAR_PATH):
+        """Loads an avatar file, or makes the default one (and saves it) if it's missing."""
+        if not os.path.exists(path):
+            print(f"Missing avatar file '{path}', creating it with the default avatar.")
+            avatar = cls()
+            avatar.save(path)
+            return avatar
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                return cls(json.load(file))
+        except (OSError, ValueError) as error:
+            print(f"Couldn't read '{path}', using the default avatar: {error}")
+            return cls()
+
+    def save(self, path:str = DEFAULT_AVATAR_PATH):
+        try:
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(self.definition, file, indent=4)
+        except OSError as error:
+            print(f"Couldn't save '{path}': {error}")
+
+class AvatarBaker():
+    """
+    Bakes avatars into single surfaces, keyed by (definition hash, pose, rainbow hue), keeping the last 'max_entries'.
+    Avatars with the same definition share their baked surfaces, so don't draw on them. The rainbow hue is rounded to 'rainbow_step' degrees, so a rainbow avatar only ever has 360 / rainbow_step bakes.
+    'res' is the resource manager the layer images come from, it can be set later.
+    """
+    def __init__(self, res=None, max_entries:int = 256, rainbow_step:int = 10) -> None:
+        self.res = res
+        self.max_entries = max_entries
+        self.rainbow_step = rainbow_step
+        self.baked = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def bake(self, avatar, pose:str = "idle", rainbow_hue:float = 0):
+        layers = avatar.definition.get("layers", [])
+        hue = round(rainbow_hue / self.rainbow_step) * self.rainbow_step % 360 if any(layer.get("rainbow") for layer in layers) else None
+        key = (avatar.key, pose, hue)
+        surface = self.baked.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.baked.move_to_end(key)
+            return surface
+
+        self.misses += 1
+        surface = self.composite(avatar.definition, pose, hue)
+        self.baked[key] = surface
+        if len(self.baked) > self.max_entries:
+            self.baked.popitem(last=False)
+        return surface
+
+    def composite(self, definition:dict, pose:str, hue):
+        profiler.count("avatar.bake")
+        pose_definition = definition.get("poses", {}).get(pose, {})
+        offsets = pose_definition.get("offsets", {})
+        hidden = pose_definition.get("hidden", [])
+
+        layers = []
+        for layer in definition.get("layers", []):
+            part = layer.get("part")
+            if part in hidden:
+                continue
+            # A copy, the resource manager's image (maybe an atlas page) must not be touched
+            image = self.res.get(layer["image"], "images", IgnoreMissing=True).copy()
+            if layer.get("hue_shift"):
+                shift_hue(image, layer["hue_shift"])
+            tint = rainbow_hsv(hue) if layer.get("rainbow") and hue is not None else layer.get("tint")
+            if tint is not None and tuple(tint[:3]) != (255, 255, 255):
+                image.fill((*tint[:3], 255), special_flags=pygame.BLEND_RGBA_MULT)
+            x, y = layer.get("offset", (0, 0))
+            extra_x, extra_y = offsets.get(part, (0, 0))
+            layers.append((image, pygame.Rect((x + extra_x, y + extra_y), image.get_size())))
+
+        if not layers:
+            return pygame.Surface((1, 1), pygame.SRCALPHA)
+        bounds = layers[0][1].unionall([rect for image, rect in layers[1:]])
+        surface = pygame.Surface(bounds.size, pygame.SRCALPHA)
+        surface.blits([(image, rect.move(-bounds.x, -bounds.y)) for image, rect in layers], doreturn=False)
+        if pose_definition.get("flip"):
+            surface = pygame.transform.flip(surface, True, False)
+        if pygame.display.get_surface() is not None:
+            surface = surface.convert_alpha()
+        return surface
+
+    def clear(self):
+        self.baked.clear()
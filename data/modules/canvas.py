@@ -0,0 +1,93 @@
+"""
+The render target of RPGOnline.
+
+The game draws on a fixed-size canvas, which gets scaled up to the window once, when the frame is presented, with nearest neighbour scaling so the pixel art stays sharp.
+A small canvas means less to fill and draw every frame, and nothing has to be scaled per sprite.
+"""
+
+import pygame
+
+try:
+    from modules.UIHandler import POINTER_EVENTS
+except ImportError:
+    from UIHandler import POINTER_EVENTS
+
+class Canvas():
+    """
+    Draw on 'surface', then pass the rects that changed to present() and the rects it returns to pygame.display.update.
+    When the canvas is the size of the window, 'surface' is the window itself and presenting costs nothing.
+    In "integer" scale mode only the changed rects get scaled, the other modes scale the whole canvas when anything changed.
+    """
+    def __init__(self, window, size, scale_mode:str = "integer") -> None:
+        self.configure(window, size, scale_mode)
+
+    def configure(self, window, size, scale_mode:str = "integer"):
+        """Sets the canvas up for a (new) window, canvas size or scale mode. Everything on the canvas is lost."""
+        self.window = window
+        self.size = (int(size[0]), int(size[1]))
+        self.scale_mode = scale_mode
+        window_width, window_height = window.get_size()
+        width, height = self.size
+        self.direct = self.size == (window_width, window_height)
+        self.factor = None
+
+        if self.direct:
+            self.surface = window
+            self.target = window.get_rect()
+        else:
+            self.surface = pygame.Surface(self.size).convert(window)
+            if scale_mode == "stretch":
+                target_size = (window_width, window_height)
+            elif scale_mode == "integer" and window_width >= width and window_height >= height:
+                self.factor = min(window_width // width, window_height // height)
+                target_size = (width * self.factor, height * self.factor)
+            else:
+                # "fit", and integer scaling when the window is smaller than the canvas
+                scale = min(window_width / width, window_height / height)
+                target_size = (max(int(width * scale), 1), max(int(height * scale), 1))
+            self.target = pygame.Rect((0, 0), target_size)
+            self.target.center = (window_width // 2, window_height // 2)
+        # The bars around the canvas have to be cleared once
+        self.full_present = True
+
+    def window_to_canvas(self, position):
+        if self.direct:
+            return position
+        return ((position[0] - self.target.x) * self.size[0] // self.target.width,
+                (position[1] - self.target.y) * self.size[1] // self.target.height)
+
+    def map_event(self, event):
+        """Pointer events with their positions moved from the window to the canvas, every other event as it is."""
+        if self.direct or event.type not in POINTER_EVENTS:
+            return event
+        mapped = dict(event.dict)
+        mapped["pos"] = self.window_to_canvas(event.pos)
+        if "rel" in mapped:
+            mapped["rel"] = (event.rel[0] * self.size[0] // self.target.width, event.rel[1] * self.size[1] // self.target.height)
+        return pygame.event.Event(event.type, mapped)
+
+    def present(self, rects):
+        """Scales the changed canvas 'rects' to the window, returns the window rects that changed."""
+        if self.direct:
+            return rects
+        if self.full_present:
+            self.full_present = False
+            self.window.fill((0, 0, 0))
+            pygame.transform.scale(self.surface, self.target.size, self.window.subsurface(self.target))
+            return [self.window.get_rect()]
+        if not rects:
+            return []
+        if self.factor is None:
+            pygame.transform.scale(self.surface, self.target.size, self.window.subsurface(self.target))
+            return [self.target.copy()]
+
+        changed = []
+        bounds = self.surface.get_rect()
+        for rect in rects:
+            rect = rect.clip(bounds)
+            if not rect.width or not rect.height:
+                continue
+            target = pygame.Rect(self.target.x + rect.x * self.factor, self.target.y + rect.y * self.factor, rect.width * self.factor, rect.height * self.factor)
+            pygame.transform.scale(self.surface.subsurface(rect), target.size, self.window.subsurface(target))
+            changed.append(target)
+        return changed
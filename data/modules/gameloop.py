@@ -0,0 +1,112 @@
+"""
+The game loop for RPGOnline.
+"""
+
+import time
+from collections import deque
+import pygame
+
+class FrameStats():
+    """
+    Rolling frame time statistics over the last 'size' frames.
+    'frame' is the whole frame including the time spent waiting for the FPS cap, 'work' is only the time spent doing something.
+    """
+    def __init__(self, size:int = 240) -> None:
+        self.frame_times = deque(maxlen=size)
+        self.work_times = deque(maxlen=size)
+
+    def add(self, frame_time:float, work_time:float):
+        self.frame_times.append(frame_time)
+        self.work_times.append(work_time)
+
+    @staticmethod
+    def percentile(times, percent:float):
+        if not times:
+            return 0.0
+        ordered = sorted(times)
+        return ordered[min(int(len(ordered) * percent / 100), len(ordered) - 1)]
+
+    def summary(self):
+        """p50/p95/p99/max of the frame and work times in milliseconds, plus the average FPS."""
+        summary = {}
+        for name, times in (("frame", self.frame_times), ("work", self.work_times)):
+            for percent in (50, 95, 99):
+                summary[f"{name}_p{percent}_ms"] = self.percentile(times, percent) * 1000
+            summary[f"{name}_max_ms"] = max(times, default=0.0) * 1000
+        total = sum(self.frame_times)
+        summary["fps"] = len(self.frame_times) / total if total else 0.0
+        return summary
+
+class GameLoop():
+    """
+    A fixed timestep loop.
+    update(dt) always gets called with the same dt ('update_rate' times a second), no matter how fast frames are drawn, so the simulation is deterministic.
+    update can return True to say it's still busy with something (like loading), which keeps the loop from going idle.
+    render(alpha) gets called once per frame, 'alpha' being how far it is between the last update and the next one (for interpolating), and should return the rects it changed.
+    Frames are capped at 'fps_cap' (0 means no cap, use that with vsync). When nothing was drawn and no events came in for 'idle_after' frames, the loop goes idle: it sleeps until an event comes in, or for at most 1 / 'idle_fps' seconds.
+    """
+    def __init__(self, update_rate:int = 60, fps_cap:int = 60, idle_fps:int = 10, idle_after:int = 30, max_updates:int = 5) -> None:
+        self.step = 1 / update_rate
+        self.fps_cap = fps_cap
+        self.idle_fps = idle_fps
+        self.idle_after = idle_after
+        self.max_updates = max_updates
+        self.clock = pygame.time.Clock()
+        self.stats = FrameStats()
+        self.accumulator = 0.0
+        self.static_frames = 0
+        self.ticks = 0
+        self.running = False
+
+    @property
+    def idle(self):
+        return self.idle_fps > 0 and self.static_frames >= self.idle_after
+
+    def get_events(self):
+        if self.idle:
+            # Nothing is going on, sleep until something happens instead of drawing the same frame again
+            event = pygame.event.wait(int(1000 / self.idle_fps))
+            if event.type == pygame.NOEVENT:
+                return []
+            return [event] + pygame.event.get()
+        return pygame.event.get()
+
+    def stop(self):
+        self.running = False
+
+    def run(self, handle_events, update, render):
+        """
+        Runs until stop() is called or handle_events returns False.
+        handle_events(events) gets the events of each frame, update(dt) runs at the fixed rate and render(alpha) draws.
+        """
+        self.running = True
+        self.clock.tick()
+        while self.running:
+            events = self.get_events()
+            work_start = time.perf_counter()
+            if handle_events(events) is False:
+                break
+
+            # Catch up on the updates since the last frame, dropping time if it fell too far behind (like after a hitch)
+            self.accumulator += self.clock.get_time() / 1000
+            updates = 0
+            busy = False
+            while self.accumulator >= self.step and updates < self.max_updates:
+                if update(self.step):
+                    busy = True
+                self.accumulator -= self.step
+                self.ticks += 1
+                updates += 1
+            if updates == self.max_updates:
+                self.accumulator = min(self.accumulator, self.step)
+
+            changed = render(self.accumulator / self.step)
+            if changed or events or busy:
+                self.static_frames = 0
+            else:
+                self.static_frames += 1
+
+            work_time = time.perf_counter() - work_start
+            self.clock.tick(self.fps_cap)
+            self.stats.add(self.clock.get_time() / 1000, work_time)
+        self.running = False
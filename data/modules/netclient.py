@@ -0,0 +1,296 @@
+"""
+The client side networking for RPGOnline.
+
+NetClient uses a non-blocking socket that gets polled once per frame, so the game loop never waits on the network.
+Snapshots from the server (see protocol.py) are rebuilt against their baselines, acknowledged, and handed to an EntityInterpolator, which draws remote entities a little in the past, in between two snapshots, so they move smoothly even when snapshots arrive unevenly.
+LinkConditioner fakes latency, jitter and packet loss for testing on localhost. Run this file to try it against a local server:
+    python data/modules/netclient.py --latency 0.08 --jitter 0.03 --loss 0.1
+"""
+
+import errno
+import random
+import select
+import socket
+import struct
+import time
+from collections import OrderedDict, deque
+import numpy as np
+
+try:
+    import modules.protocol as Protocol
+    from modules.world import CHUNK_SIZE
+except ImportError:
+    import protocol as Protocol
+    from world import CHUNK_SIZE
+
+# Anything the socket or a broken message from the server can raise, they disconnect instead of reaching the game loop
+CONNECTION_ERRORS = (OSError, Protocol.ProtocolError, struct.error, ValueError)
+
+class LinkConditioner():
+    """
+    Holds messages back to fake a slow and unreliable link: each message is delayed by 'latency' plus up to 'jitter' seconds, and snapshots are dropped with a 'loss' chance.
+    The connection is TCP, so messages still arrive in order and only snapshots (which the protocol can do without) get lost.
+    """
+    def __init__(self, latency:float = 0.0, jitter:float = 0.0, loss:float = 0.0, seed:int = None) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.queue = deque()
+        self.last_delivery = 0.0
+        self.dropped = 0
+
+    def push(self, message_type:int, payload, now:float):
+        if message_type == Protocol.SNAPSHOT and self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        delivery = max(now + self.latency + self.random.uniform(0, self.jitter), self.last_delivery)
+        self.last_delivery = delivery
+        self.queue.append((delivery, message_type, payload))
+
+    def pop_ready(self, now:float):
+        ready = []
+        while self.queue and self.queue[0][0] <= now:
+            ready.append(self.queue.popleft()[1:])
+        return ready
+
+class EntityInterpolator():
+    """
+    Keeps the last few full snapshots with their server time, and gives entity positions 'delay' seconds behind the newest server time it has seen, interpolated between the two snapshots around that time.
+    When the snapshots run out (lost or late ones) it keeps the entities going the way they were for up to 'max_extrapolation' seconds, then holds them.
+    """
+    def __init__(self, delay:float = 0.1, buffer_size:int = 32, max_extrapolation:float = 0.1) -> None:
+        self.delay = delay
+        self.max_extrapolation = max_extrapolation
+        self.snapshots = deque(maxlen=buffer_size)
+        # Local clock -> server clock, smoothed so jitter doesn't make entities stutter
+        self.clock_offset = None
+
+    def add(self, server_time:float, state, now:float):
+        if self.snapshots and server_time <= self.snapshots[-1][0]:
+            return
+        self.snapshots.append((server_time, state))
+        offset = server_time - now
+        if self.clock_offset is None or offset > self.clock_offset:
+            # A snapshot that arrived early is the best estimate of the real offset
+            self.clock_offset = offset
+        else:
+            self.clock_offset += (offset - self.clock_offset) * 0.05
+
+    def render_time(self, now:float):
+        return now + (self.clock_offset or 0.0) - self.delay
+
+    def sample(self, now:float):
+        """An ENTITY array with the interpolated positions, sorted by id."""
+        if not self.snapshots:
+            return Protocol.NO_ENTITIES
+        target = self.render_time(now)
+        if target <= self.snapshots[0][0]:
+            return self.snapshots[0][1]
+        for index in range(len(self.snapshots) - 1, -1, -1):
+            if self.snapshots[index][0] <= target:
+                break
+        if index == len(self.snapshots) - 1:
+            if index == 0:
+                return self.snapshots[0][1]
+            index -= 1
+
+        (time_a, state_a), (time_b, state_b) = self.snapshots[index], self.snapshots[index + 1]
+        alpha = np.float32(min(target - time_a, time_b - time_a + self.max_extrapolation) / (time_b - time_a))
+        result = state_b.copy()
+        # Entities that are in both snapshots get interpolated, new ones just show up where they are
+        common, index_a, index_b = np.intersect1d(state_a["id"], state_b["id"], assume_unique=True, return_indices=True)
+        result["x"][index_b] = state_a["x"][index_a] + (state_b["x"][index_b] - state_a["x"][index_a]) * alpha
+        result["y"][index_b] = state_a["y"][index_a] + (state_b["y"][index_b] - state_a["y"][index_a]) * alpha
+        return result
+
+class NetClient():
+    """
+    Call poll() once per frame. It never blocks: it finishes connecting, reads whatever arrived, handles it and sends whatever is waiting.
+    """
+    def __init__(self, name:str = "Player", conditioner=None, interpolation_delay:float = 0.1) -> None:
+        self.name = name
+        self.conditioner = conditioner
+        self.socket = None
+        self.state = "disconnected"  # "connecting", "connected" or "disconnected"
+        self.reader = Protocol.MessageReader()
+        self.outgoing = bytearray()
+        self.client_id = None
+        self.entity_id = None
+        self.tick_rate = None
+        self.snapshots = OrderedDict()
+        self.latest_tick = 0
+        # Ids that came into and left the area of interest with the last snapshot, and tile changes the world hasn't taken yet
+        self.entered = Protocol.NO_IDS
+        self.left = Protocol.NO_IDS
+        self.tile_changes = deque()
+        self.interpolator = EntityInterpolator(interpolation_delay)
+        self.bytes_received = 0
+        self.snapshots_received = 0
+        self.error = None
+
+    def connect(self, host:str, port:int):
+        self.close()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setblocking(False)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        result = self.socket.connect_ex((host, port))
+        if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, "WSAEWOULDBLOCK", -1)):
+            self.fail(OSError(result, errno.errorcode.get(result, "connect failed")))
+            return
+        self.state = "connecting"
+        self.error = None
+        self.reader = Protocol.MessageReader()
+        self.outgoing = bytearray(Protocol.pack_hello(self.name))
+
+    def send(self, message:bytes):
+        if self.state != "disconnected":
+            self.outgoing += message
+
+    def send_input(self, dx:int, dy:int):
+        self.send(Protocol.pack_input(dx, dy))
+
+    def poll(self, now:float = None):
+        if self.socket is None:
+            return
+        if now is None:
+            now = time.perf_counter()
+        try:
+            if self.state == "connecting" and not self.finish_connecting():
+                return
+            self.receive(now)
+            self.flush()
+            if self.conditioner is not None:
+                for message_type, payload in self.conditioner.pop_ready(now):
+                    self.handle(message_type, payload, now)
+        except CONNECTION_ERRORS as error:
+            self.fail(error)
+
+    def finish_connecting(self):
+        """
+        Checks on a pending connect without blocking, returns True once the socket is connected.
+        Reading or writing before that fails differently on every platform (ENOTCONN, WSAENOTCONN, ...), so nothing touches the socket until it's writable and SO_ERROR says the connect went through.
+        """
+        # Windows reports a failed connect in the exceptional list, everything else reports it as writable
+        _, writable, failed = select.select([], [self.socket], [self.socket], 0)
+        if not writable and not failed:
+            return False
+        error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error != 0:
+            raise OSError(error, errno.errorcode.get(error, "connect failed"))
+        self.state = "connected"
+        return True
+
+    def receive(self, now:float):
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            if not data:
+                raise ConnectionResetError("Server closed the connection")
+            self.bytes_received += len(data)
+            for message_type, payload in self.reader.feed(data):
+                if self.conditioner is not None:
+                    self.conditioner.push(message_type, payload, now)
+                else:
+                    self.handle(message_type, payload, now)
+
+    def flush(self):
+        while self.outgoing:
+            try:
+                sent = self.socket.send(self.outgoing)
+            except (BlockingIOError, InterruptedError):
+                return
+            del self.outgoing[:sent]
+
+    def handle(self, message_type:int, payload:bytes, now:float):
+        if message_type == Protocol.WELCOME:
+            self.client_id, self.entity_id, self.tick_rate = Protocol.unpack_welcome(payload)
+            print(f"Connected as client {self.client_id}")
+        elif message_type == Protocol.SNAPSHOT:
+            tick, baseline, changed, removed, entered = Protocol.unpack_snapshot(payload)
+            if baseline:
+                base = self.snapshots.get(baseline)
+                if base is None:
+                    # Don't have that baseline anymore, wait for one that can be rebuilt
+                    return
+            else:
+                base = Protocol.NO_ENTITIES
+            state = Protocol.apply_snapshot(base, changed, removed)
+            self.snapshots[tick] = state
+            while len(self.snapshots) > 64:
+                self.snapshots.popitem(last=False)
+            self.latest_tick = max(self.latest_tick, tick)
+            self.entered = entered["id"]
+            self.left = removed
+            self.snapshots_received += 1
+            self.interpolator.add(tick / (self.tick_rate or 20), state, now)
+            self.send(Protocol.pack_ack(tick))
+        elif message_type == Protocol.TILES:
+            self.tile_changes.append(Protocol.unpack_tiles(payload))
+
+    def apply_tile_changes(self, world):
+        """Puts the tile changes the server sent into 'world' (a World), call it once per frame."""
+        while self.tile_changes:
+            for change in self.tile_changes.popleft():
+                world.set_tile(int(change["cx"]) * CHUNK_SIZE + int(change["x"]), int(change["cy"]) * CHUNK_SIZE + int(change["y"]), int(change["tile"]))
+
+    def entities(self, now:float = None):
+        """Where to draw the remote entities this frame."""
+        return self.interpolator.sample(time.perf_counter() if now is None else now)
+
+    def fail(self, error):
+        print(f"Disconnected: {error}")
+        self.error = error
+        self.close()
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+        self.socket = None
+        self.state = "disconnected"
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+    import threading
+    import serverengine as ServerEngine
+
+    parser = argparse.ArgumentParser(description="Runs a local server and a client with a faked bad connection.")
+    parser.add_argument("--port", type=int, default=24681)
+    parser.add_argument("--latency", type=float, default=0.08)
+    parser.add_argument("--jitter", type=float, default=0.03)
+    parser.add_argument("--loss", type=float, default=0.1)
+    parser.add_argument("--npcs", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=5.0)
+    arguments = parser.parse_args()
+
+    engine = ServerEngine.ServerEngine(npcs=arguments.npcs, seed=1)
+    server_thread = threading.Thread(target=asyncio.run, args=(engine.run("127.0.0.1", arguments.port, arguments.duration + 2, 60.0),), daemon=True)
+    server_thread.start()
+    time.sleep(0.3)
+
+    client = NetClient("tester", LinkConditioner(arguments.latency, arguments.jitter, arguments.loss, seed=1))
+    client.connect("127.0.0.1", arguments.port)
+    frame_times = []
+    jumps = []
+    previous = None
+    start = time.perf_counter()
+    while time.perf_counter() - start < arguments.duration:
+        frame_start = time.perf_counter()
+        client.poll()
+        entities = client.entities()
+        if previous is not None and len(entities) and len(previous):
+            common, index_a, index_b = np.intersect1d(previous["id"], entities["id"], return_indices=True)
+            moved = np.hypot(entities["x"][index_b] - previous["x"][index_a], entities["y"][index_b] - previous["y"][index_a])
+            jumps.append(float(moved.max()) if len(moved) else 0.0)
+        previous = entities
+        frame_times.append(time.perf_counter() - frame_start)
+        time.sleep(1 / 60)
+    engine.stop()
+
+    print(f"State: {client.state}, {client.snapshots_received} snapshots rebuilt, {client.conditioner.dropped} dropped, {client.bytes_received / 1024:.1f} KiB received")
+    print(f"poll + interpolation: {sum(frame_times) / len(frame_times) * 1000:.3f} ms avg, {max(frame_times) * 1000:.3f} ms max")
+    if jumps:
+        print(f"Biggest per-frame move of an entity: {max(jumps):.2f} px (NPCs move at most 48 px/s, so 0.8 px per frame is smooth)")
@@ -0,0 +1,119 @@
+"""
+The profiler for RPGOnline.
+
+Times each phase of a frame and counts expensive calls (surface allocations, font renders, transforms), shows them in a debug overlay, and can dump everything as a Chrome trace (open it in chrome://tracing or https://ui.perfetto.dev).
+Everything goes through the shared 'profiler' object, which does nothing until it's enabled:
+
+    with profiler.phase("update"):
+        ...
+    profiler.count("font.render")
+"""
+
+import json
+import time
+from collections import deque
+from contextlib import nullcontext
+import pygame
+
+class Phase():
+    def __init__(self, profiler, name:str) -> None:
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.profiler.add_phase(self.name, self.start, time.perf_counter())
+        return False
+
+class Profiler():
+    def __init__(self, history:int = 120, max_trace_events:int = 200000) -> None:
+        self.enabled = False
+        self.started = time.perf_counter()
+        # Totals of the frame being recorded, and of the last 'history' frames
+        self.phases = {}
+        self.counters = {}
+        self.frame_start = None
+        self.frames = deque(maxlen=history)
+        self.trace = deque(maxlen=max_trace_events)
+        self.null_phase = nullcontext()
+        self.font = None
+
+    def enable(self, enabled:bool = True):
+        self.enabled = enabled
+        if not enabled:
+            self.phases = {}
+            self.counters = {}
+            self.frame_start = None
+
+    def toggle(self):
+        self.enable(not self.enabled)
+
+    def phase(self, name:str):
+        """A context manager that times whatever runs inside it under 'name'."""
+        if not self.enabled:
+            return self.null_phase
+        return Phase(self, name)
+
+    def add_phase(self, name:str, start:float, end:float):
+        self.phases[name] = self.phases.get(name, 0.0) + end - start
+        self.trace.append({"name": name, "ph": "X", "ts": (start - self.started) * 1e6, "dur": (end - start) * 1e6, "pid": 0, "tid": 0})
+
+    def count(self, name:str, amount:int = 1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def begin_frame(self):
+        if self.enabled:
+            self.frame_start = time.perf_counter()
+
+    def end_frame(self):
+        if not self.enabled or self.frame_start is None:
+            return
+        end = time.perf_counter()
+        self.add_phase("frame", self.frame_start, end)
+        for name, value in self.counters.items():
+            self.trace.append({"name": name, "ph": "C", "ts": (end - self.started) * 1e6, "pid": 0, "tid": 0, "args": {"count": value}})
+        self.frames.append((self.phases, self.counters))
+        self.phases = {}
+        self.counters = {}
+        self.frame_start = None
+
+    def summary(self):
+        """Average milliseconds per phase and average counts per frame, over the recorded frames."""
+        phases = {}
+        counters = {}
+        for frame_phases, frame_counters in self.frames:
+            for name, seconds in frame_phases.items():
+                phases[name] = phases.get(name, 0.0) + seconds
+            for name, value in frame_counters.items():
+                counters[name] = counters.get(name, 0) + value
+        frames = max(len(self.frames), 1)
+        return ({name: seconds * 1000 / frames for name, seconds in phases.items()},
+                {name: value / frames for name, value in counters.items()})
+
+    def dump_trace(self, path:str):
+        with open(path, "w") as file:
+            json.dump({"traceEvents": list(self.trace), "displayTimeUnit": "ms"}, file)
+        print(f"Saved profiler trace to '{path}'")
+
+    def render_overlay(self, surface, position=(0, 0)):
+        """Draws the averages in an opaque box, returns the rect it drew over."""
+        if self.font is None:
+            self.font = pygame.font.Font(None, 18)
+        phases, counters = self.summary()
+        lines = [f"{name}: {milliseconds:.2f} ms" for name, milliseconds in sorted(phases.items())]
+        lines += [f"{name}: {value:.1f}/frame" for name, value in sorted(counters.items())]
+        if not lines:
+            lines = ["Profiling..."]
+        rendered = [self.font.render(line, True, (255, 255, 255)) for line in lines]
+        line_height = self.font.get_linesize()
+        rect = pygame.Rect(position, (max(text.get_width() for text in rendered) + 8, line_height * len(rendered) + 8))
+        surface.fill((0, 0, 0), rect)
+        surface.blits([(text, (rect.x + 4, rect.y + 4 + line_height * index)) for index, text in enumerate(rendered)], doreturn=False)
+        return rect
+
+profiler = Profiler()
@@ -0,0 +1,133 @@
+"""
+The network protocol for RPGOnline.
+
+Every message is a small header (payload length, protocol version, message type) followed by a binary payload packed with struct, entity lists are packed straight from NumPy structured arrays.
+Snapshots are deltas: they only carry the entities that changed since the snapshot the client last acknowledged (the baseline), plus the ids of the ones that are gone. A baseline tick of 0 means a full snapshot.
+The entities that entered the client's area of interest since the baseline come first in the changed list, so the client knows which ones are new (the removed ids are the ones that left).
+"""
+
+import struct
+import numpy as np
+
+PROTOCOL_VERSION = 2
+HEADER = struct.Struct("<IBB")  # Payload length, protocol version, message type
+MAX_PAYLOAD = 16 * 1024 * 1024
+
+# Message types
+HELLO = 1  # Client -> server: name
+WELCOME = 2  # Server -> client: client id, the client's entity id, tick rate
+SNAPSHOT = 3  # Server -> client: entity changes against a baseline
+ACK = 4  # Client -> server: last snapshot tick received
+INPUT = 5  # Client -> server: movement direction
+TILES = 6  # Server -> client: tile changes in chunks of the client's area of interest
+
+ENTITY = np.dtype([("id", "<u4"), ("x", "<f4"), ("y", "<f4")])
+NO_ENTITIES = np.zeros(0, ENTITY)
+NO_IDS = np.zeros(0, "<u4")
+TILE_CHANGE = np.dtype([("cx", "<i4"), ("cy", "<i4"), ("x", "u1"), ("y", "u1"), ("tile", "<u2")])
+
+WELCOME_PAYLOAD = struct.Struct("<IIH")
+SNAPSHOT_HEADER = struct.Struct("<IIIII")  # Tick, baseline tick, entered entities, changed entities (entered ones included), removed entities
+ACK_PAYLOAD = struct.Struct("<I")
+INPUT_PAYLOAD = struct.Struct("<bb")
+
+class ProtocolError(Exception):
+    pass
+
+def pack(message_type:int, payload:bytes = b""):
+    return HEADER.pack(len(payload), PROTOCOL_VERSION, message_type) + payload
+
+class MessageReader():
+    """Splits a byte stream back into (message type, payload) pairs, however the bytes were cut up on the way."""
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+
+    def feed(self, data:bytes):
+        self.buffer += data
+        messages = []
+        while len(self.buffer) >= HEADER.size:
+            length, version, message_type = HEADER.unpack_from(self.buffer, 0)
+            if version != PROTOCOL_VERSION:
+                raise ProtocolError(f"Protocol version {version} isn't supported (this is version {PROTOCOL_VERSION})")
+            if length > MAX_PAYLOAD:
+                raise ProtocolError(f"Message of {length} bytes is too big")
+            if len(self.buffer) < HEADER.size + length:
+                break
+            messages.append((message_type, bytes(self.buffer[HEADER.size:HEADER.size + length])))
+            del self.buffer[:HEADER.size + length]
+        return messages
+
+def pack_hello(name:str):
+    return pack(HELLO, name.encode("utf-8")[:64])
+
+def unpack_hello(payload:bytes):
+    return payload.decode("utf-8", "replace")
+
+def pack_welcome(client_id:int, entity_id:int, tick_rate:int):
+    return pack(WELCOME, WELCOME_PAYLOAD.pack(client_id, entity_id, tick_rate))
+
+def unpack_welcome(payload:bytes):
+    return WELCOME_PAYLOAD.unpack(payload)
+
+def pack_snapshot(tick:int, baseline:int, changed, removed, entered:int = 0):
+    """'changed' has to start with the 'entered' entities that are new to the client."""
+    header = SNAPSHOT_HEADER.pack(tick, baseline, entered, len(changed), len(removed))
+    return pack(SNAPSHOT, header + changed.astype(ENTITY, copy=False).tobytes() + removed.astype("<u4", copy=False).tobytes())
+
+def unpack_snapshot(payload:bytes):
+    """Returns (tick, baseline tick, changed entities, removed ids, entered entities), the entered ones are a view of the start of the changed ones."""
+    tick, baseline, entered_count, changed_count, removed_count = SNAPSHOT_HEADER.unpack_from(payload, 0)
+    offset = SNAPSHOT_HEADER.size
+    changed = np.frombuffer(payload, ENTITY, changed_count, offset)
+    offset += changed_count * ENTITY.itemsize
+    removed = np.frombuffer(payload, "<u4", removed_count, offset)
+    return tick, baseline, changed, removed, changed[:entered_count]
+
+def pack_ack(tick:int):
+    return pack(ACK, ACK_PAYLOAD.pack(tick))
+
+def unpack_ack(payload:bytes):
+    return ACK_PAYLOAD.unpack(payload)[0]
+
+def pack_input(dx:int, dy:int):
+    return pack(INPUT, INPUT_PAYLOAD.pack(dx, dy))
+
+def unpack_input(payload:bytes):
+    return INPUT_PAYLOAD.unpack(payload)
+
+def pack_tiles(changes):
+    return pack(TILES, changes.astype(TILE_CHANGE, copy=False).tobytes())
+
+def unpack_tiles(payload:bytes):
+    return np.frombuffer(payload, TILE_CHANGE)
+
+def delta(current, baseline):
+    """
+    The entities of 'current' that are new or moved compared to 'baseline', the ids in 'baseline' that aren't in 'current', and how many of the changed ones are new.
+    The new ones come first. Both have to be sorted by id. With no baseline everything counts as new.
+    """
+    if baseline is None or len(baseline) == 0:
+        return current, NO_IDS, len(current)
+    if len(current) == 0:
+        return NO_ENTITIES, baseline["id"], 0
+    index = np.minimum(np.searchsorted(baseline["id"], current["id"]), len(baseline) - 1)
+    matched = baseline[index]
+    present = matched["id"] == current["id"]
+    moved = present & ((matched["x"] != current["x"]) | (matched["y"] != current["y"]))
+    # Same lookup the other way around, cheaper than np.setdiff1d
+    kept = current["id"][np.minimum(np.searchsorted(current["id"], baseline["id"]), len(current) - 1)] == baseline["id"]
+    removed = baseline["id"][~kept]
+    entered = current[~present]
+    if not len(entered):
+        return current[moved], removed, 0
+    return np.concatenate([entered, current[moved]]), removed, len(entered)
+
+def apply_snapshot(state, changed, removed):
+    """Applies a delta to 'state' (the entity array the client has for the baseline), returns the new array sorted by id."""
+    if len(removed):
+        state = state[~np.isin(state["id"], removed)]
+    if len(changed):
+        state = state[~np.isin(state["id"], changed["id"])]
+        state = np.concatenate([state, changed])
+        state = state[np.argsort(state["id"], kind="stable")]
+    return state
@@ -4,6 +4,16 @@ The resource manager for RPGOnline.
 
 import pygame
 import os
+import random
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from modules.profiler import profiler
+except ImportError:
+    # Imported straight from the modules folder, like UIHandler's demo does
+    from profiler import profiler
 
 def reference_image(path:str):
     if os.path.exists(path):
@@ -17,11 +27,326 @@ def reference_audio(path:str):
     else:
         return None
     
+def decode_asset(path:str, elementtype:str):
+    """
+    Reads and decodes a file without touching the display, so it's safe to run on a worker thread.
+    Images still need convert_alpha() on the main thread afterwards.
+    """
+    try:
+        if elementtype == "images":
+            return pygame.image.load(path)
+        elif elementtype == "audio":
+            return pygame.mixer.Sound(path)
+    except (pygame.error, OSError) as error:
+        print(f"Couldn't load '{path}': {error}")
+    return None
+
+# One font object per (file, size), shared by everyone that asks for it
+fonts = {}
+
+def reference_font(path:str, size:int):
+    key = (os.path.normpath(path), size)
+    font = fonts.get(key)
+    if font is None:
+        if os.path.exists(path):
+            font = pygame.font.Font(path, size)
+        else:
+            print(f"Missing font file '{path}', using the default font.")
+            font = pygame.font.Font(None, size)
+        fonts[key] = font
+    return font
+
+class TextCache():
+    """
+    A bounded cache of rendered text, keyed by (font, text, color, antialias).
+    The least recently used entries get dropped once there are more than 'max_entries'.
+    """
+    def __init__(self, max_entries:int = 512) -> None:
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, font, text:str, color, antialias:bool = True):
+        key = (font, text, tuple(color), antialias)
+        surface = self.entries.get(key)
+        if surface is None:
+            self.misses += 1
+            profiler.count("font.render")
+            surface = font.render(text, antialias, color)
+            self.entries[key] = surface
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return surface
+
+    def clear(self):
+        self.entries.clear()
+
+text_cache = TextCache()
+
+def render_text(font, text:str, color, antialias:bool = True):
+    """
+    Same as font.render, but the result comes from the shared text cache, so don't draw on it.
+    """
+    return text_cache.render(font, text, color, antialias)
+
+class GlyphAtlas():
+    """
+    Every glyph of a font in one color, pre-rendered into a single surface.
+    Meant for text that changes all the time (chat, damage numbers, counters), where caching whole strings would never hit.
+    Glyphs are placed one after the other, so there's no kerning, which is fine for the pixel fonts.
+    """
+    def __init__(self, font, color, antialias:bool = True, characters:str = None) -> None:
+        self.font = font
+        self.color = color
+        self.antialias = antialias
+        self.height = font.get_height()
+        self.glyphs = {}
+        if characters is None:
+            characters = "".join(chr(code) for code in range(32, 127))
+        self.build(characters)
+
+    def build(self, characters:str):
+        rendered = [(character, self.font.render(character, self.antialias, self.color)) for character in characters]
+        width = sum(surface.get_width() for character, surface in rendered)
+        self.surface = pygame.Surface((max(width, 1), self.height), pygame.SRCALPHA)
+        x = 0
+        for character, surface in rendered:
+            self.surface.blit(surface, (x, 0))
+            self.glyphs[character] = self.surface.subsurface((x, 0, surface.get_width(), self.height))
+            x += surface.get_width()
+
+    def get_glyph(self, character:str):
+        glyph = self.glyphs.get(character)
+        if glyph is None:
+            # Not in the atlas, render it on its own and keep it
+            profiler.count("font.render")
+            glyph = self.font.render(character, self.antialias, self.color)
+            self.glyphs[character] = glyph
+        return glyph
+
+    def size(self, text:str):
+        return (sum(self.get_glyph(character).get_width() for character in text), self.height)
+
+    def render(self, text:str):
+        glyphs = [self.get_glyph(character) for character in text]
+        profiler.count("surface")
+        surface = pygame.Surface((max(sum(glyph.get_width() for glyph in glyphs), 1), self.height), pygame.SRCALPHA)
+        blits = []
+        x = 0
+        for glyph in glyphs:
+            blits.append((glyph, (x, 0)))
+            x += glyph.get_width()
+        surface.blits(blits, doreturn=False)
+        return surface
+
+class TextureAtlas():
+    """
+    Packs small images into a few big surfaces (pages), so drawing lots of them touches less memory and batches well with Surface.blits.
+    It's a shelf packer: images go left to right on a shelf, each shelf is as tall as the image that started it, new shelves go under the last one and a new page starts when a page is full.
+    add() gives back a subsurface of the page, which behaves like the original image everywhere.
+    Pages can be freed as a whole with remove_page(), their slot in 'pages' is None until a new page reuses it.
+    """
+    def __init__(self, page_size=(1024, 1024), max_sprite_size:int = 128, padding:int = 1) -> None:
+        self.page_size = page_size
+        self.max_sprite_size = max_sprite_size
+        # Empty pixels around every image, so smooth scaling never bleeds the neighbours in
+        self.padding = padding
+        self.pages = []
+        # Per page, a list of [y, height, next free x] for each shelf
+        self.shelves = []
+        self.regions = {}
+
+    def fits(self, surface):
+        width, height = surface.get_size()
+        return 0 < width <= self.max_sprite_size and 0 < height <= self.max_sprite_size
+
+    def place(self, page:int, width:int, height:int):
+        shelves = self.shelves[page]
+        # The shortest shelf the image fits on, so tall shelves aren't used up by small images
+        best = None
+        for shelf in shelves:
+            if height <= shelf[1] and shelf[2] + width <= self.page_size[0] and (best is None or shelf[1] < best[1]):
+                best = shelf
+        if best is not None:
+            position = (best[2], best[0])
+            best[2] += width
+            return position
+        top = shelves[-1][0] + shelves[-1][1] if shelves else 0
+        if top + height > self.page_size[1]:
+            return None
+        shelves.append([top, height, width])
+        return (0, top)
+
+    def new_page(self):
+        page = pygame.Surface(self.page_size, pygame.SRCALPHA)
+        if pygame.display.get_surface() is not None:
+            page = page.convert_alpha()
+        page.fill((0, 0, 0, 0))
+        if None in self.pages:
+            index = self.pages.index(None)
+            self.pages[index] = page
+            self.shelves[index] = []
+            return index
+        self.pages.append(page)
+        self.shelves.append([])
+        return len(self.pages) - 1
+
+    def page_ids(self, page:int):
+        return [id for id, (region_page, rect) in self.regions.items() if region_page == page]
+
+    def remove_page(self, page:int):
+        """Frees a page, returns the ids of the images that were on it. Their subsurfaces keep the page alive until they're gone too."""
+        ids = self.page_ids(page)
+        for id in ids:
+            del self.regions[id]
+        self.pages[page] = None
+        self.shelves[page] = []
+        return ids
+
+    def page_bytes(self, page:int):
+        surface = self.pages[page]
+        return surface.get_width() * surface.get_height() * surface.get_bytesize() if surface is not None else 0
+
+    def resident_bytes(self):
+        return sum(self.page_bytes(page) for page in range(len(self.pages)))
+
+    def add(self, id:str, surface, new_page:bool = True):
+        """Copies 'surface' into the atlas and returns its subsurface, or None if it's too big for the atlas (or the pages are full and 'new_page' is False)."""
+        if not self.fits(surface):
+            return None
+        width, height = surface.get_width() + self.padding, surface.get_height() + self.padding
+        for page in range(len(self.pages)):
+            position = self.place(page, width, height) if self.pages[page] is not None else None
+            if position is not None:
+                break
+        else:
+            if not new_page:
+                return None
+            page = self.new_page()
+            position = self.place(page, width, height)
+        rect = pygame.Rect(position, surface.get_size())
+        # The page is transparent there, so taking the max copies the pixels, alpha included, without blending
+        self.pages[page].blit(surface, rect, special_flags=pygame.BLEND_RGBA_MAX)
+        self.regions[id] = (page, rect)
+        return self.pages[page].subsurface(rect)
+
+    def get_stats(self):
+        used = sum(rect.width * rect.height for page, rect in self.regions.values())
+        pages = sum(page is not None for page in self.pages)
+        total = pages * self.page_size[0] * self.page_size[1]
+        return {"pages": pages, "images": len(self.regions), "bytes": self.resident_bytes(), "fill": used / total if total else 0.0}
+
+class AssetLoader():
+    """
+    Loads assets into a Res on a pool of worker threads.
+    The workers read and decode the files, and poll(), called from the main thread once per frame, hands the results to the resource manager (doing the convert_alpha() there, as it needs the display).
+    Assets queued as critical are the ones the first screen needs, everything else can keep loading after it shows up.
+    """
+    def __init__(self, res, workers:int = 4) -> None:
+        self.res = res
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = []
+        self.sources = {}
+        self.total = 0
+        self.loaded = 0
+        self.critical_left = 0
+
+    def submit(self, function, args:tuple, id:str, elementtype:str, critical:bool = True):
+        future = self.executor.submit(function, *args)
+        self.pending.append((future, id, elementtype, critical))
+        # So Res can load it again if it gets evicted
+        self.sources[future] = (function, args)
+        self.total += 1
+        if critical:
+            self.critical_left += 1
+
+    def queue(self, path:str, id:str, elementtype:str, critical:bool = True):
+        self.submit(decode_asset, (path, elementtype), id, elementtype, critical)
+
+    def queue_pack(self, pack, critical_types:tuple = ("images",), check_loose:bool = True):
+        """
+        Queues everything in an AssetPack (see assetpack.py), the types in 'critical_types' are critical.
+        With 'check_loose', loose files that are newer than the pack (or not in it) get loaded instead of the packed ones.
+        """
+        overridden = set()
+        if check_loose:
+            for path, id, elementtype in pack.find_loose_changes():
+                self.queue(path, id, elementtype, elementtype in critical_types)
+                overridden.add((id, elementtype))
+        for id, elementtype in pack.list():
+            if (id, elementtype) not in overridden:
+                self.submit(pack.decode, (id, elementtype), id, elementtype, elementtype in critical_types)
+
+    def queue_directory(self, directory:str, extensions:tuple, elementtype:str, critical:bool = True):
+        if not os.path.isdir(directory):
+            print(f"Missing asset directory '{directory}'")
+            return
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith(extensions):
+                self.queue(os.path.join(directory, filename), filename.rsplit(".", 1)[0], elementtype, critical)
+
+    def poll(self, time_budget:float = 0.004):
+        """
+        Hands finished assets over to the resource manager, critical ones first.
+        Stops after 'time_budget' seconds, so a frame never stalls on a pile of conversions. Returns the progress, from 0 to 1.
+        """
+        start = time.perf_counter()
+        # Critical assets first, the rest keep their order
+        self.pending.sort(key=lambda entry: not entry[3])
+        still_pending = []
+        for entry in self.pending:
+            future, id, elementtype, critical = entry
+            if not future.done() or time.perf_counter() - start > time_budget:
+                still_pending.append(entry)
+                continue
+            content = future.result()
+            if content is not None and elementtype == "images":
+                content = content.convert_alpha()
+            self.res.append(content, id, source=self.sources.pop(future))
+            self.loaded += 1
+            if critical:
+                self.critical_left -= 1
+        self.pending = still_pending
+        return self.progress
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    @property
+    def progress(self):
+        return self.loaded / self.total if self.total else 1.0
+
+    @property
+    def critical_loaded(self):
+        return self.critical_left == 0
+
+    @property
+    def finished(self):
+        return not self.pending
+
 class Res():
-    def __init__(self) -> None:
-        self.res = {"images": {}, "audio": {}}
+    def __init__(self, atlas_max_sprite_size:int = 128, atlas_page_size=(1024, 1024)) -> None:
+        # Music is only stored as file paths, MusicPlayer streams it from disk
+        self.res = {"images": {}, "audio": {}, "music": {}}
         self.default_image_path = "data/textures/missing.png"
         self.default_audio_path = "data/sounds/missing.ogg"
+        # Scaled copies of images, keyed by (id, size, smooth, opaque), shared by every caller
+        self.scaled = {}
+        self.display_size = None
+        # Memory management, per element type: how to reload each element, its size in bytes, when it was last used and who is holding it
+        self.sources = {"images": {}, "audio": {}}
+        self.sizes = {"images": {}, "audio": {}}
+        self.last_used = {"images": {}, "audio": {}}
+        self.refcounts = {"images": {}, "audio": {}}
+        self.budgets = {}
+        self.use_counter = 0
+        self.stats = {"hits": 0, "misses": 0, "reloads": 0, "evictions": 0}
+        # Images up to atlas_max_sprite_size pixels a side get packed into atlas pages, 0 turns that off
+        self.atlas = TextureAtlas(atlas_page_size, atlas_max_sprite_size) if atlas_max_sprite_size else None
         self.load_defaults()
 
     def load_defaults(self):
@@ -29,7 +354,10 @@ class Res():
             self.default_image = pygame.image.load(self.default_image_path)
         else:
             print(f"Missing image file '{self.default_image_path}'")
-            self.default_image = pygame.Surface((1, 1))  # Placeholder surface for missing images
+            self.default_image = pygame.Surface((1, 1), pygame.SRCALPHA)  # Placeholder surface for missing images
+        # missing.png may be 8-bit, which smoothscale can't take
+        if pygame.display.get_surface() is not None:
+            self.default_image = self.default_image.convert_alpha()
 
         if os.path.exists(self.default_audio_path):
             self.default_audio = pygame.mixer.Sound(self.default_audio_path)
@@ -37,29 +365,312 @@ class Res():
             print(f"Missing audio file '{self.default_audio_path}'")
             self.default_audio = None  # Placeholder for missing audio
 
-    def append(self, content: any, id: str):
+    def append(self, content: any, id: str, source: tuple = None):
+        """
+        Adds an element. 'source' is an optional (function, args) that gives the element back when called, elements with a source can be evicted to stay under the memory budget and get reloaded when they're needed again.
+        """
         if content is None:
             print(f"Skipped loading of None element '{id}'")
+            return
         elif isinstance(content, pygame.surface.Surface):
-            if id in self.res["images"]:
-                print(f"Skipped content, as it would overwrite element '{id}' of type '{type(content)}'.")
-            else:
-                print(f"Loaded image '{id}'.")
-                self.res["images"][id] = content
+            elementtype = "images"
         elif isinstance(content, pygame.mixer.Sound):
-            if id in self.res["audio"]:
-                print(f"Skipped content, as it would overwrite element '{id}' of type '{type(content)}'.")
-            else:
-                print(f"Loaded sound '{id}'.")
-                self.res["audio"][id] = content
+            elementtype = "audio"
+        else:
+            return
+
+        if id in self.res[elementtype]:
+            print(f"Skipped content, as it would overwrite element '{id}' of type '{type(content)}'.")
+            return
+        if elementtype == "images":
+            print(f"Loaded image '{id}'.")
+        else:
+            print(f"Loaded sound '{id}'.")
+        self.store(content, id, elementtype)
+        self.touch(id, elementtype)
+        if source is not None:
+            self.sources[elementtype][id] = source
+        self.enforce_budget(elementtype, keep=id)
+
+    def store(self, content, id:str, elementtype:str, new_page:bool = True):
+        """
+        Puts an element in, small images go into the atlas. Atlas images count as 0 bytes, their pages are counted instead.
+        Without 'new_page' an image only goes into the atlas if there's room on a page already, so a reload never brings a whole page back (and evicts another one for it).
+        """
+        if elementtype == "images" and self.atlas is not None:
+            atlased = self.atlas.add(id, content, new_page)
+            if atlased is not None:
+                self.res[elementtype][id] = atlased
+                self.sizes[elementtype][id] = 0
+                return atlased
+        self.res[elementtype][id] = content
+        self.sizes[elementtype][id] = self.measure(content)
+        return content
+
+    def measure(self, content):
+        """Roughly how many bytes an element takes up in memory."""
+        if isinstance(content, pygame.surface.Surface):
+            return content.get_width() * content.get_height() * content.get_bytesize()
+        mixer = pygame.mixer.get_init()
+        if mixer is None:
+            return 0
+        frequency, size, channels = mixer
+        return int(content.get_length() * frequency * channels * abs(size) // 8)
+
+    def touch(self, id:str, elementtype:str):
+        self.use_counter += 1
+        self.last_used[elementtype][id] = self.use_counter
+
+    def set_budget(self, elementtype:str, max_bytes:int):
+        """Limits how much memory elements of a type can take, evicting the least recently used ones that nobody holds. None removes the limit."""
+        if max_bytes is None:
+            self.budgets.pop(elementtype, None)
+        else:
+            self.budgets[elementtype] = max_bytes
+            self.enforce_budget(elementtype)
+
+    def resident_bytes(self, elementtype:str):
+        resident = sum(self.sizes[elementtype].values())
+        if elementtype == "images" and self.atlas is not None:
+            resident += self.atlas.resident_bytes()
+        return resident
+
+    def evictable(self, id:str, elementtype:str, keep:str = None):
+        """Only elements that can be reloaded and aren't held by anyone can go."""
+        return id != keep and id in self.sources[elementtype] and not self.refcounts[elementtype].get(id)
+
+    def enforce_budget(self, elementtype:str, keep:str = None):
+        budget = self.budgets.get(elementtype)
+        if budget is None:
+            return
+        resident = self.resident_bytes(elementtype)
+        if resident <= budget:
+            return
+        # (last used, bytes, ids, atlas page) for everything that could go. An atlas page only goes as a whole, when every image on it can, and counts as used when its newest image was
+        atlased = self.atlas.regions if self.atlas is not None and elementtype == "images" else {}
+        candidates = [(self.last_used[elementtype].get(id, 0), self.sizes[elementtype][id], [id], None) for id in self.res[elementtype]
+                      if id not in atlased and self.evictable(id, elementtype, keep)]
+        if atlased:
+            for page in range(len(self.atlas.pages)):
+                ids = self.atlas.page_ids(page)
+                if ids and all(self.evictable(id, elementtype, keep) for id in ids):
+                    candidates.append((max(self.last_used[elementtype].get(id, 0) for id in ids), self.atlas.page_bytes(page), ids, page))
+        candidates.sort(key=lambda candidate: candidate[0])
+        for last_used, size, ids, page in candidates:
+            if resident <= budget:
+                break
+            resident -= size
+            for id in ids:
+                self.evict(id, elementtype)
+            if page is not None:
+                self.atlas.remove_page(page)
+
+    def evict(self, id:str, elementtype:str):
+        del self.res[elementtype][id]
+        self.sizes[elementtype].pop(id, None)
+        self.stats["evictions"] += 1
+        if elementtype == "images":
+            for key in [key for key in self.scaled if key[0] == id]:
+                del self.scaled[key]
+
+    def reload(self, id:str, elementtype:str):
+        function, args = self.sources[elementtype][id]
+        content = function(*args)
+        if content is None:
+            return None
+        if elementtype == "images":
+            content = content.convert_alpha()
+        self.stats["reloads"] += 1
+        content = self.store(content, id, elementtype, new_page=False)
+        self.enforce_budget(elementtype, keep=id)
+        return content
+
+    def acquire(self, id:str, elementtype:str, IgnoreMissing:bool = False):
+        """Same as get, but the element won't be evicted until it's released."""
+        refcounts = self.refcounts.get(elementtype)
+        if refcounts is not None:
+            refcounts[id] = refcounts.get(id, 0) + 1
+        return self.get(id, elementtype, IgnoreMissing)
+
+    def release(self, id:str, elementtype:str):
+        refcounts = self.refcounts.get(elementtype)
+        if refcounts is not None and refcounts.get(id):
+            refcounts[id] -= 1
+            if refcounts[id] == 0:
+                del refcounts[id]
+                self.enforce_budget(elementtype)
+
+    def get_stats(self):
+        """Hit/miss/reload/eviction counts, plus how many elements and bytes of each type are loaded right now."""
+        stats = dict(self.stats)
+        for elementtype in ("images", "audio"):
+            stats[elementtype] = {"loaded": len(self.res[elementtype]), "bytes": self.resident_bytes(elementtype), "budget": self.budgets.get(elementtype)}
+        stats["scaled_bytes"] = sum(self.measure(surface) for surface in self.scaled.values())
+        if self.atlas is not None:
+            stats["atlas"] = self.atlas.get_stats()
+        return stats
+
+    def append_music(self, path:str, id:str):
+        """
+        Registers a music track. Unlike sounds it isn't decoded here, MusicPlayer streams it when it plays.
+        """
+        if not os.path.exists(path):
+            print(f"Skipped loading of missing music file '{path}'")
+        elif id in self.res["music"]:
+            print(f"Skipped content, as it would overwrite music '{id}'.")
+        else:
+            print(f"Registered music '{id}'.")
+            self.res["music"][id] = path
 
     def get(self, id:str, elementtype:str, IgnoreMissing:bool = False):
         try:
-            return self.res[elementtype][id]
+            content = self.res[elementtype][id]
+            if elementtype in self.last_used:
+                self.stats["hits"] += 1
+                self.touch(id, elementtype)
+            return content
         except KeyError:
+            if elementtype in self.last_used:
+                self.stats["misses"] += 1
+            # Evicted earlier, load it again
+            if id in self.sources.get(elementtype, ()):
+                self.touch(id, elementtype)
+                content = self.reload(id, elementtype)
+                if content is not None:
+                    return content
             if not IgnoreMissing:
                 print(f"There is no such element as '{id}' of type '{elementtype}'! Use 'IgnoreMissing' to ignore this error.")
             if elementtype == "images":
                 return self.default_image
             elif elementtype == "audio":
                 return self.default_audio
+
+    def set_display_size(self, size):
+        """
+        Tells the manager the current window size. Scaled images are only valid for one window size, so they get dropped when it changes.
+        """
+        size = tuple(size)
+        if size != self.display_size:
+            self.display_size = size
+            self.scaled.clear()
+
+    def get_scaled(self, id:str, size, smooth:bool = False, opaque:bool = False, IgnoreMissing:bool = False):
+        """
+        Returns the image 'id' scaled to 'size', building it only the first time it's asked for.
+        'smooth' uses smoothscale instead of the pixel-art friendly nearest neighbour scale, and 'opaque' converts the result to the display format without alpha, which blits faster for things like backgrounds.
+        The returned surface is shared, so don't draw on it.
+        """
+        size = (int(size[0]), int(size[1]))
+        key = (id, size, smooth, opaque)
+        scaled = self.scaled.get(key)
+        if scaled is None:
+            image = self.get(id, "images", IgnoreMissing)
+            profiler.count("transform.scale")
+            if smooth:
+                # smoothscale only takes 24 and 32-bit images
+                if image.get_bitsize() < 24:
+                    image = image.convert_alpha()
+                scaled = pygame.transform.smoothscale(image, size)
+            else:
+                scaled = pygame.transform.scale(image, size)
+            if opaque:
+                scaled = scaled.convert()
+            self.scaled[key] = scaled
+        return scaled
+
+class MusicPlayer():
+    """
+    Plays music through pygame.mixer.music, which streams and decodes the file while it plays, so a track is never fully loaded into memory.
+    It goes through a playlist of music ids from a Res, queueing the next track so it starts without a gap.
+    pygame can only stream one track at a time, so a crossfade is a fade out of the current track followed by a fade in of the next one.
+    Call handle_event with every event, so it knows when a track ends.
+    """
+    def __init__(self, res, crossfade_ms:int = 0, loop:bool = True) -> None:
+        self.res = res
+        self.crossfade_ms = crossfade_ms
+        self.loop = loop
+        self.playlist = []
+        self.index = 0
+        self.queued_index = None
+        self.switching_to = None
+        self.playing = False
+        self.end_event = pygame.event.custom_type()
+
+    def available(self):
+        return pygame.mixer.get_init() is not None
+
+    def set_playlist(self, ids:list, shuffle:bool = False):
+        self.playlist = list(ids)
+        if shuffle:
+            random.shuffle(self.playlist)
+        self.index = 0
+        self.queued_index = None
+
+    def next_index(self, index:int):
+        if index + 1 < len(self.playlist):
+            return index + 1
+        return 0 if self.loop and self.playlist else None
+
+    def play(self, index:int = 0, fade_ms:int = 0):
+        if not self.available() or not self.playlist:
+            return
+        path = self.res.get(self.playlist[index], "music")
+        if path is None:
+            return
+        self.index = index
+        self.switching_to = None
+        pygame.mixer.music.load(path)
+        pygame.mixer.music.set_endevent(self.end_event)
+        pygame.mixer.music.play(fade_ms=fade_ms)
+        self.playing = True
+        self.queue_next()
+
+    def queue_next(self):
+        # Queued tracks start right as the current one ends, with no gap
+        self.queued_index = self.next_index(self.index)
+        if self.queued_index is not None:
+            path = self.res.get(self.playlist[self.queued_index], "music")
+            if path is None:
+                self.queued_index = None
+            else:
+                pygame.mixer.music.queue(path)
+
+    def switch(self, index:int):
+        """Goes to another track of the playlist, crossfading if crossfade_ms is set."""
+        if not self.available():
+            return
+        if self.playing and self.crossfade_ms > 0:
+            # The fade in happens once the fade out is over and the end event comes in
+            self.switching_to = index
+            self.queued_index = None
+            pygame.mixer.music.fadeout(self.crossfade_ms)
+        else:
+            self.play(index)
+
+    def next(self):
+        index = self.next_index(self.index)
+        if index is not None:
+            self.switch(index)
+
+    def stop(self, fade_ms:int = 0):
+        self.playing = False
+        self.switching_to = None
+        self.queued_index = None
+        if self.available():
+            pygame.mixer.music.set_endevent()
+            if fade_ms > 0:
+                pygame.mixer.music.fadeout(fade_ms)
+            else:
+                pygame.mixer.music.stop()
+
+    def handle_event(self, event):
+        if event.type != self.end_event or not self.playing:
+            return
+        if self.switching_to is not None:
+            self.play(self.switching_to, fade_ms=self.crossfade_ms)
+        elif self.queued_index is not None:
+            # The queued track already started playing
+            self.index = self.queued_index
+            self.queue_next()
+        else:
+            self.playing = False
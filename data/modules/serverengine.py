@@ -0,0 +1,413 @@
+"""
+The server engine for RPGOnline.
+
+An asyncio server that runs the simulation at a fixed tick rate and sends every client delta-compressed snapshots (see protocol.py), each one against the last snapshot that client acknowledged.
+Clients only get what's inside their area of interest: the world chunks around their player. Entities are bucketed by chunk every tick (InterestGrid), so building a client's snapshot costs about the same however big the world gets.
+It's headless, and comes with simulated clients and a benchmark so it can be load tested on localhost.
+"""
+
+import asyncio
+import random
+import time
+from collections import OrderedDict, deque
+import numpy as np
+
+try:
+    import modules.protocol as Protocol
+    from modules.world import CHUNK_SIZE, CHUNK_PIXELS
+except ImportError:
+    import protocol as Protocol
+    from world import CHUNK_SIZE, CHUNK_PIXELS
+
+class ClientState():
+    """
+    'writer' can be None (for benchmarks), the messages are only counted then.
+    'snapshots' has what this client was sent each tick, they are its possible baselines. 'area' is the chunk rectangle (cx0, cy0, cx1, cy1) it can see.
+    """
+    def __init__(self, client_id:int, writer, entity_id:int, name:str) -> None:
+        self.id = client_id
+        self.writer = writer
+        self.entity_id = entity_id
+        self.name = name
+        self.acked_tick = 0
+        self.bytes_sent = 0
+        self.snapshots_sent = 0
+        self.direction = (0, 0)
+        self.snapshots = OrderedDict()
+        self.area = None
+        self.tiles_synced = False
+        self.entered = 0
+        self.left = 0
+
+class InterestGrid():
+    """
+    Entity indices bucketed by the world chunk they're in, rebuilt every tick with one sort.
+    The keys sort by chunk column then row, so each column of an area is one range, found with a binary search.
+    """
+    def __init__(self, cell_size:float = CHUNK_PIXELS) -> None:
+        self.cell_size = cell_size
+        self.order = np.zeros(0, np.intp)
+        self.keys = np.zeros(0, np.int64)
+
+    @staticmethod
+    def key(cx, cy):
+        # Rows get biased into an unsigned range, so negative ones still sort below row 0 within a column
+        return (np.asarray(cx, np.int64) << 32) + ((np.asarray(cy, np.int64) + 2 ** 31) & 0xFFFFFFFF)
+
+    def rebuild(self, positions):
+        cells = np.floor_divide(positions, self.cell_size).astype(np.int64)
+        keys = self.key(cells[:, 0], cells[:, 1])
+        self.order = np.argsort(keys, kind="stable")
+        self.keys = keys[self.order]
+
+    def query(self, cx0:int, cy0:int, cx1:int, cy1:int):
+        """Indices of the entities in the chunks from (cx0, cy0) to (cx1, cy1) inclusive, sorted."""
+        columns = np.arange(cx0, cx1 + 1, dtype=np.int64)
+        starts = np.searchsorted(self.keys, self.key(columns, cy0), "left")
+        ends = np.searchsorted(self.keys, self.key(columns, cy1), "right")
+        indices = np.concatenate([self.order[start:end] for start, end in zip(starts, ends)])
+        indices.sort()
+        return indices
+
+class ServerEngine():
+    """
+    Entities are kept in NumPy arrays (ids, positions, velocities) sorted by id, so simulating and diffing them is vectorized.
+    The last 'history' snapshots of each client are kept as baselines, a client whose acknowledged snapshot is older than that gets a full one.
+    Clients see the chunks within 'interest_radius' chunks of their player, None means they see everything.
+    """
+    def __init__(self, tick_rate:int = 20, npcs:int = 0, seed:int = 0, history:int = 64, player_speed:float = 96.0, world_size:float = 4096.0, max_buffered_bytes:int = 256 * 1024, interest_radius:int = 2) -> None:
+        self.tick_rate = tick_rate
+        self.dt = 1 / tick_rate
+        self.history = history
+        self.player_speed = player_speed
+        self.world_size = world_size
+        self.max_buffered_bytes = max_buffered_bytes
+        self.random = np.random.default_rng(seed)
+
+        self.ids = np.zeros(0, np.uint32)
+        self.positions = np.zeros((0, 2), np.float32)
+        self.velocities = np.zeros((0, 2), np.float32)
+        self.is_npc = np.zeros(0, bool)
+        self.next_entity_id = 1
+
+        self.clients = {}
+        self.next_client_id = 1
+        self.tick = 0
+        self.interest_radius = interest_radius
+        self.grid = InterestGrid()
+        # Tiles changed since the world was generated, by chunk, and the ones changed this tick
+        self.tile_edits = {}
+        self.tile_changes = []
+
+        self.tick_times = deque(maxlen=tick_rate * 10)
+        self.running = False
+        self.server = None
+
+        if npcs:
+            self.spawn_many(self.random.uniform(0, world_size, (npcs, 2)), npc=True)
+
+    # Entities
+
+    def spawn(self, x:float, y:float, npc:bool = False):
+        entity_id = self.next_entity_id
+        self.next_entity_id += 1
+        # Ids only go up, so appending keeps the arrays sorted
+        self.ids = np.append(self.ids, np.uint32(entity_id))
+        self.positions = np.vstack([self.positions, np.array([[x, y]], np.float32)])
+        self.velocities = np.vstack([self.velocities, np.zeros((1, 2), np.float32)])
+        self.is_npc = np.append(self.is_npc, npc)
+        return entity_id
+
+    def spawn_many(self, positions, npc:bool = False):
+        count = len(positions)
+        ids = np.arange(self.next_entity_id, self.next_entity_id + count, dtype=np.uint32)
+        self.next_entity_id += count
+        self.ids = np.concatenate([self.ids, ids])
+        self.positions = np.vstack([self.positions, np.asarray(positions, np.float32)])
+        self.velocities = np.vstack([self.velocities, np.zeros((count, 2), np.float32)])
+        self.is_npc = np.concatenate([self.is_npc, np.full(count, npc)])
+        return ids
+
+    def despawn(self, entity_id:int):
+        keep = self.ids != entity_id
+        self.ids = self.ids[keep]
+        self.positions = self.positions[keep]
+        self.velocities = self.velocities[keep]
+        self.is_npc = self.is_npc[keep]
+
+    def entity_index(self, entity_id:int):
+        index = int(np.searchsorted(self.ids, entity_id))
+        if index < len(self.ids) and self.ids[index] == entity_id:
+            return index
+        return None
+
+    # Simulation
+
+    def simulate(self):
+        # Players move where their client says
+        for client in self.clients.values():
+            index = self.entity_index(client.entity_id)
+            if index is not None:
+                self.velocities[index] = np.array(client.direction, np.float32) * self.player_speed
+
+        # NPCs wander, changing direction now and then
+        if self.is_npc.any():
+            turning = self.is_npc & (self.random.random(len(self.ids)) < 0.05)
+            count = int(turning.sum())
+            if count:
+                angles = self.random.uniform(0, 2 * np.pi, count)
+                speeds = self.random.uniform(0, 48, count)
+                self.velocities[turning] = np.stack([np.cos(angles), np.sin(angles)], axis=1) * speeds[:, np.newaxis]
+
+        self.positions += self.velocities * np.float32(self.dt)
+        np.clip(self.positions, 0, self.world_size, out=self.positions)
+
+    def set_tile(self, x:int, y:int, tile:int):
+        """Changes a tile (in world tile coordinates), the clients that can see its chunk get told next tick."""
+        cx, cy = x // CHUNK_SIZE, y // CHUNK_SIZE
+        x, y = x % CHUNK_SIZE, y % CHUNK_SIZE
+        self.tile_edits.setdefault((cx, cy), {})[(x, y)] = tile
+        self.tile_changes.append((cx, cy, x, y, tile))
+
+    def take_snapshot(self):
+        snapshot = np.empty(len(self.ids), Protocol.ENTITY)
+        snapshot["id"] = self.ids
+        snapshot["x"] = self.positions[:, 0]
+        snapshot["y"] = self.positions[:, 1]
+        if self.interest_radius is not None:
+            self.grid.rebuild(self.positions)
+        return snapshot
+
+    # Interest management
+
+    def area_of(self, client):
+        """The chunk rectangle around the client's player, or None if it sees everything."""
+        if self.interest_radius is None:
+            return None
+        index = self.entity_index(client.entity_id)
+        if index is None:
+            return client.area
+        cx, cy = (int(value) for value in self.positions[index] // CHUNK_PIXELS)
+        return (cx - self.interest_radius, cy - self.interest_radius, cx + self.interest_radius, cy + self.interest_radius)
+
+    def update_interest(self, client, changes):
+        """
+        Moves the client's area along with its player. Returns the tiles message for it (or None): every edit of the chunks that just came into its area, and this tick's changes in the rest of it.
+        """
+        area = self.area_of(client)
+        if area is None:
+            entering = () if client.tiles_synced else list(self.tile_edits)
+        elif area == client.area or not self.tile_edits:
+            entering = ()
+        else:
+            chunks = {(cx, cy) for cx in range(area[0], area[2] + 1) for cy in range(area[1], area[3] + 1)}
+            if client.area is not None:
+                chunks.difference_update((cx, cy) for cx in range(client.area[0], client.area[2] + 1) for cy in range(client.area[1], client.area[3] + 1))
+            entering = [chunk for chunk in chunks if chunk in self.tile_edits]
+        client.area = area
+        client.tiles_synced = True
+
+        # The chunks that came in already have this tick's changes in their edits
+        rows = [(cx, cy, x, y, tile) for cx, cy in entering for (x, y), tile in self.tile_edits[(cx, cy)].items()]
+        if len(changes):
+            inside = ~np.isin(InterestGrid.key(changes["cx"], changes["cy"]), InterestGrid.key(*np.array(list(entering), np.int64).reshape(-1, 2).T))
+            if area is not None:
+                inside &= (changes["cx"] >= area[0]) & (changes["cx"] <= area[2]) & (changes["cy"] >= area[1]) & (changes["cy"] <= area[3])
+            changes = changes[inside]
+        if rows:
+            changes = np.concatenate([np.array(rows, Protocol.TILE_CHANGE), changes])
+        if not len(changes):
+            return None
+        return Protocol.pack_tiles(changes)
+
+    def snapshot_for(self, client, snapshot):
+        """The snapshot message for one client: what changed in its area since its acknowledged snapshot."""
+        if client.area is not None:
+            snapshot = snapshot[self.grid.query(*client.area)]
+        client.snapshots[self.tick] = snapshot
+        while len(client.snapshots) > self.history:
+            client.snapshots.popitem(last=False)
+        baseline = client.snapshots.get(client.acked_tick) if client.acked_tick else None
+        changed, removed, entered = Protocol.delta(snapshot, baseline)
+        client.entered += entered
+        client.left += len(removed)
+        return Protocol.pack_snapshot(self.tick, client.acked_tick if baseline is not None else 0, changed, removed, entered)
+
+    def send(self, client, message:bytes):
+        if client.writer is not None:
+            client.writer.write(message)
+        client.bytes_sent += len(message)
+
+    def step(self):
+        """One tick: simulate, then send every client the tile changes and snapshot of its area."""
+        start = time.perf_counter()
+        self.tick += 1
+        self.simulate()
+        snapshot = self.take_snapshot()
+        changes = np.array(self.tile_changes, Protocol.TILE_CHANGE)
+        self.tile_changes = []
+        for client in list(self.clients.values()):
+            # Tile changes are only sent once, so they can't be skipped
+            tiles = self.update_interest(client, changes)
+            if tiles is not None:
+                self.send(client, tiles)
+            # A client that can't keep up gets skipped, its next snapshot is just a bigger delta
+            if client.writer is not None and client.writer.transport.get_write_buffer_size() > self.max_buffered_bytes:
+                continue
+            self.send(client, self.snapshot_for(client, snapshot))
+            client.snapshots_sent += 1
+        self.tick_times.append(time.perf_counter() - start)
+
+    # Networking
+
+    async def handle_client(self, reader, writer):
+        reader_state = Protocol.MessageReader()
+        client = None
+        try:
+            while self.running:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for message_type, payload in reader_state.feed(data):
+                    if message_type == Protocol.HELLO and client is None:
+                        entity_id = self.spawn(*self.random.uniform(0, self.world_size, 2))
+                        client = ClientState(self.next_client_id, writer, entity_id, Protocol.unpack_hello(payload))
+                        self.next_client_id += 1
+                        self.clients[client.id] = client
+                        writer.write(Protocol.pack_welcome(client.id, entity_id, self.tick_rate))
+                    elif client is None:
+                        continue
+                    elif message_type == Protocol.ACK:
+                        tick = Protocol.unpack_ack(payload)
+                        if tick > client.acked_tick:
+                            client.acked_tick = tick
+                    elif message_type == Protocol.INPUT:
+                        dx, dy = Protocol.unpack_input(payload)
+                        client.direction = (max(-1, min(1, dx)), max(-1, min(1, dy)))
+        except (ConnectionError, Protocol.ProtocolError) as error:
+            print(f"Client dropped: {error}")
+        finally:
+            if client is not None:
+                self.clients.pop(client.id, None)
+                self.despawn(client.entity_id)
+            writer.close()
+
+    async def run(self, host:str = "127.0.0.1", port:int = 24680, duration:float = None, report_interval:float = 5.0, on_report=None):
+        """
+        Serves until stop() is called or 'duration' seconds pass.
+        Every 'report_interval' seconds the stats get printed (or passed to 'on_report').
+        """
+        self.running = True
+        self.server = await asyncio.start_server(self.handle_client, host, port)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        next_tick = start
+        next_report = start + report_interval
+        last_bytes = {}
+        try:
+            while self.running and (duration is None or loop.time() - start < duration):
+                self.step()
+                next_tick += self.dt
+                now = loop.time()
+                if now >= next_report:
+                    report = self.report(now - next_report + report_interval, last_bytes)
+                    if on_report is not None:
+                        on_report(report)
+                    else:
+                        print(format_report(report))
+                    next_report = now + report_interval
+                # If a tick ran late, don't try to catch up with a burst of ticks
+                next_tick = max(next_tick, now)
+                await asyncio.sleep(next_tick - now)
+        finally:
+            self.running = False
+            self.server.close()
+            for client in list(self.clients.values()):
+                client.writer.close()
+            # Let the client handlers see their connections closing, before asyncio.run cancels them
+            await asyncio.sleep(0.05)
+            await self.server.wait_closed()
+
+    def stop(self):
+        self.running = False
+
+    def report(self, elapsed:float, last_bytes:dict):
+        """Tick duration and bandwidth per client since the last report."""
+        sent = []
+        for client in self.clients.values():
+            sent.append(client.bytes_sent - last_bytes.get(client.id, 0))
+            last_bytes[client.id] = client.bytes_sent
+        times = sorted(self.tick_times)
+        return {
+            "tick": self.tick,
+            "clients": len(self.clients),
+            "entities": len(self.ids),
+            "tick_avg_ms": sum(times) / len(times) * 1000 if times else 0.0,
+            "tick_p99_ms": times[min(int(len(times) * 0.99), len(times) - 1)] * 1000 if times else 0.0,
+            "bytes_per_client_per_second": sum(sent) / len(sent) / elapsed if sent and elapsed else 0.0,
+        }
+
+def format_report(report:dict):
+    return (f"tick {report['tick']}: {report['clients']} clients, {report['entities']} entities, "
+            f"tick {report['tick_avg_ms']:.2f} ms avg / {report['tick_p99_ms']:.2f} ms p99, "
+            f"{report['bytes_per_client_per_second'] / 1024:.1f} KiB/s per client")
+
+async def simulated_client(host:str, port:int, name:str, duration:float, seed:int = 0):
+    """
+    A fake player for load testing: decodes every snapshot against its baseline, acknowledges it and wanders around.
+    Returns how many snapshots it got.
+    """
+    generator = random.Random(seed)
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(Protocol.pack_hello(name))
+    message_reader = Protocol.MessageReader()
+    states = OrderedDict()
+    received = 0
+    loop = asyncio.get_running_loop()
+    end = loop.time() + duration
+    try:
+        while loop.time() < end:
+            try:
+                data = await asyncio.wait_for(reader.read(65536), timeout=max(end - loop.time(), 0.01))
+            except asyncio.TimeoutError:
+                break
+            if not data:
+                break
+            for message_type, payload in message_reader.feed(data):
+                if message_type != Protocol.SNAPSHOT:
+                    continue
+                tick, baseline, changed, removed, entered = Protocol.unpack_snapshot(payload)
+                base = states.get(baseline, Protocol.NO_ENTITIES) if baseline else Protocol.NO_ENTITIES
+                states[tick] = Protocol.apply_snapshot(base, changed, removed)
+                while len(states) > 64:
+                    states.popitem(last=False)
+                received += 1
+                writer.write(Protocol.pack_ack(tick))
+                if generator.random() < 0.1:
+                    writer.write(Protocol.pack_input(generator.randint(-1, 1), generator.randint(-1, 1)))
+    finally:
+        writer.close()
+    return received
+
+def benchmark(players:int, npcs:int, interest_radius:int = 2, ticks:int = 40, world_size:float = 16384.0, seed:int = 0):
+    """
+    Runs 'ticks' ticks with 'players' players that acknowledge every snapshot, without any sockets.
+    Returns the average tick time in milliseconds and the bytes sent per player per tick.
+    """
+    engine = ServerEngine(npcs=npcs, seed=seed, world_size=world_size, interest_radius=interest_radius)
+    generator = random.Random(seed)
+    for index in range(players):
+        entity_id = engine.spawn(*engine.random.uniform(0, world_size, 2))
+        engine.clients[index + 1] = ClientState(index + 1, None, entity_id, f"bot{index}")
+    # The first tick sends everything, it isn't what a running server costs
+    engine.step()
+    engine.tick_times.clear()
+    first_bytes = sum(client.bytes_sent for client in engine.clients.values())
+    for tick in range(ticks):
+        for client in engine.clients.values():
+            client.acked_tick = engine.tick
+            if generator.random() < 0.1:
+                client.direction = (generator.randint(-1, 1), generator.randint(-1, 1))
+        engine.step()
+    sent = sum(client.bytes_sent for client in engine.clients.values()) - first_bytes
+    return sum(engine.tick_times) / len(engine.tick_times) * 1000, sent / max(players, 1) / ticks
@@ -0,0 +1,104 @@
+"""
+The settings of RPGOnline, kept in data/Settings.ini.
+
+The file is read once at startup (and written with the defaults if it isn't there). Changing a setting with set() tells the listeners right away, so the game can apply it without restarting.
+"""
+
+import configparser
+import os
+
+DEFAULT_SETTINGS_PATH = "data/Settings.ini"
+
+SCALE_MODES = ("integer", "fit", "stretch")
+
+DEFAULTS = {
+    "Display": {
+        # The window, and the canvas everything gets drawn on before it's scaled up to the window
+        "window_width": "800",
+        "window_height": "600",
+        "internal_width": "800",
+        "internal_height": "600",
+        # integer: biggest whole scale that fits, with black bars. fit: keeps the aspect ratio. stretch: fills the window
+        "scale_mode": "integer",
+        "vsync": "false",
+    },
+    "Performance": {
+        # 0 means no cap (use that with vsync)
+        "fps_cap": "60",
+    },
+}
+
+class Settings():
+    def __init__(self, path:str = DEFAULT_SETTINGS_PATH) -> None:
+        self.path = path
+        self.config = configparser.ConfigParser()
+        self.config.read_dict(DEFAULTS)
+        # Called with (settings, section, key) after a setting changes
+        self.listeners = []
+
+    def load(self):
+        if not os.path.exists(self.path):
+            print(f"Missing settings file '{self.path}', creating it with the defaults.")
+            self.save()
+            return
+        try:
+            self.config.read(self.path, encoding="utf-8")
+        except configparser.Error as error:
+            print(f"Couldn't read '{self.path}', using the defaults: {error}")
+
+    def save(self):
+        try:
+            with open(self.path, "w", encoding="utf-8") as file:
+                self.config.write(file)
+        except OSError as error:
+            print(f"Couldn't save '{self.path}': {error}")
+
+    def get(self, section:str, key:str):
+        return self.config.get(section, key, fallback=DEFAULTS[section][key])
+
+    def get_int(self, section:str, key:str, minimum:int = 0):
+        try:
+            value = self.config.getint(section, key)
+        except ValueError:
+            print(f"Setting '{key}' isn't a whole number, using {DEFAULTS[section][key]}.")
+            value = int(DEFAULTS[section][key])
+        return max(value, minimum)
+
+    def get_bool(self, section:str, key:str):
+        try:
+            return self.config.getboolean(section, key)
+        except ValueError:
+            print(f"Setting '{key}' isn't true or false, using {DEFAULTS[section][key]}.")
+            return DEFAULTS[section][key] == "true"
+
+    def set(self, section:str, key:str, value):
+        """Changes a setting (not saved until save() is called) and tells the listeners."""
+        if isinstance(value, bool):
+            value = "true" if value else "false"
+        self.config.set(section, key, str(value))
+        for listener in self.listeners:
+            listener(self, section, key)
+
+    @property
+    def window_size(self):
+        return (self.get_int("Display", "window_width", 1), self.get_int("Display", "window_height", 1))
+
+    @property
+    def internal_size(self):
+        return (self.get_int("Display", "internal_width", 1), self.get_int("Display", "internal_height", 1))
+
+    @property
+    def scale_mode(self):
+        mode = self.get("Display", "scale_mode").lower()
+        if mode not in SCALE_MODES:
+            print(f"Unknown scale mode '{mode}', using integer. It can be one of: {', '.join(SCALE_MODES)}")
+            return "integer"
+        return mode
+
+    @property
+    def vsync(self):
+        return self.get_bool("Display", "vsync")
+
+    @property
+    def fps_cap(self):
+        return self.get_int("Performance", "fps_cap")
@@ -0,0 +1,165 @@
+"""
+The tile world for RPGOnline.
+
+Tiles are stored in fixed-size chunks of NumPy arrays (tile id, metadata and light), never as one Python object per tile.
+Each chunk bakes its tiles into a surface once, and only bakes again after one of its tiles changed. The camera only draws the chunks it can see.
+"""
+
+from collections import OrderedDict
+import numpy as np
+import pygame
+
+CHUNK_SIZE = 32  # Tiles per chunk side
+TILE_SIZE = 16  # Pixels per tile side
+CHUNK_PIXELS = CHUNK_SIZE * TILE_SIZE
+AIR = 0  # Tile id that is never drawn
+FULL_LIGHT = 255
+
+class Chunk():
+    """
+    CHUNK_SIZE x CHUNK_SIZE tiles, indexed [y, x].
+    'dirty' means it changed since it was last saved, the baked surface has its own flag.
+    """
+    def __init__(self, cx:int, cy:int, tiles=None, metadata=None, light=None) -> None:
+        self.cx = cx
+        self.cy = cy
+        self.tiles = tiles if tiles is not None else np.zeros((CHUNK_SIZE, CHUNK_SIZE), np.uint16)
+        self.metadata = metadata if metadata is not None else np.zeros((CHUNK_SIZE, CHUNK_SIZE), np.uint8)
+        self.light = light if light is not None else np.full((CHUNK_SIZE, CHUNK_SIZE), FULL_LIGHT, np.uint8)
+        self.surface = None
+        self.surface_dirty = True
+        self.dirty = False
+
+    def get_tile(self, x:int, y:int):
+        return int(self.tiles[y, x])
+
+    def set_tile(self, x:int, y:int, tile:int, metadata:int = 0):
+        if self.tiles[y, x] == tile and self.metadata[y, x] == metadata:
+            return
+        self.tiles[y, x] = tile
+        self.metadata[y, x] = metadata
+        self.surface_dirty = True
+        self.dirty = True
+
+    def set_light(self, light):
+        """Replaces the whole light map (CHUNK_SIZE x CHUNK_SIZE, 0 is black, 255 is fully lit)."""
+        self.light = np.asarray(light, np.uint8)
+        self.surface_dirty = True
+        self.dirty = True
+
+    def bake(self, tileset):
+        """Draws every tile into the chunk's surface, only call it when surface_dirty is set."""
+        if self.surface is None:
+            self.surface = pygame.Surface((CHUNK_PIXELS, CHUNK_PIXELS), pygame.SRCALPHA)
+        self.surface.fill((0, 0, 0, 0))
+
+        ys, xs = np.nonzero(self.tiles != AIR)
+        tiles = self.tiles[ys, xs]
+        self.surface.blits([(tileset.get(int(tile)), (int(x) * TILE_SIZE, int(y) * TILE_SIZE)) for tile, x, y in zip(tiles, xs, ys)], doreturn=False)
+
+        # Darken by the light map, scaled up to one light value per tile
+        if (self.light != FULL_LIGHT).any():
+            light = np.repeat(self.light.T[:, :, np.newaxis], 3, axis=2)
+            shade = pygame.transform.scale(pygame.surfarray.make_surface(light), (CHUNK_PIXELS, CHUNK_PIXELS))
+            self.surface.blit(shade, (0, 0), special_flags=pygame.BLEND_RGB_MULT)
+
+        self.surface_dirty = False
+
+    def get_surface(self, tileset):
+        if self.surface_dirty or self.surface is None:
+            self.bake(tileset)
+        return self.surface
+
+    def release_surface(self):
+        self.surface = None
+        self.surface_dirty = True
+
+class TileSet():
+    """
+    Tile id -> texture id in a Res. Textures are scaled to TILE_SIZE through Res.get_scaled, so they're only scaled once.
+    """
+    def __init__(self, res, textures:dict = None) -> None:
+        self.res = res
+        self.textures = dict(textures or {})
+
+    def add(self, tile:int, texture_id:str):
+        self.textures[tile] = texture_id
+
+    def get(self, tile:int):
+        return self.res.get_scaled(self.textures.get(tile, "missing"), (TILE_SIZE, TILE_SIZE), IgnoreMissing=True)
+
+class World():
+    """
+    Chunks by (cx, cy). Chunks that don't exist yet come from 'generator' (a function taking cx, cy and returning a Chunk) or start empty.
+    At most 'max_baked_chunks' chunk surfaces are kept, the least recently drawn ones are let go.
+    """
+    def __init__(self, tileset, generator=None, max_baked_chunks:int = 64) -> None:
+        self.tileset = tileset
+        self.generator = generator
+        self.chunks = {}
+        self.baked = OrderedDict()
+        self.max_baked_chunks = max_baked_chunks
+
+    @staticmethod
+    def chunk_coords(x:int, y:int):
+        """Chunk of a tile and the tile's position inside it."""
+        return x // CHUNK_SIZE, y // CHUNK_SIZE, x % CHUNK_SIZE, y % CHUNK_SIZE
+
+    def add_chunk(self, chunk):
+        self.chunks[(chunk.cx, chunk.cy)] = chunk
+
+    def get_chunk(self, cx:int, cy:int, create:bool = True):
+        chunk = self.chunks.get((cx, cy))
+        if chunk is None and create:
+            chunk = self.generator(cx, cy) if self.generator is not None else Chunk(cx, cy)
+            self.chunks[(cx, cy)] = chunk
+        return chunk
+
+    def get_tile(self, x:int, y:int):
+        cx, cy, tx, ty = self.chunk_coords(x, y)
+        chunk = self.get_chunk(cx, cy, create=False)
+        return chunk.get_tile(tx, ty) if chunk is not None else AIR
+
+    def set_tile(self, x:int, y:int, tile:int, metadata:int = 0):
+        cx, cy, tx, ty = self.chunk_coords(x, y)
+        self.get_chunk(cx, cy).set_tile(tx, ty, tile, metadata)
+
+    def get_chunk_surface(self, chunk):
+        key = (chunk.cx, chunk.cy)
+        self.baked[key] = chunk
+        self.baked.move_to_end(key)
+        while len(self.baked) > self.max_baked_chunks:
+            self.baked.popitem(last=False)[1].release_surface()
+        return chunk.get_surface(self.tileset)
+
+class Camera():
+    """
+    A view of the world, 'x' and 'y' being the world pixel at the top left of the screen.
+    """
+    def __init__(self, size, x:float = 0, y:float = 0) -> None:
+        self.width, self.height = size
+        self.x = x
+        self.y = y
+
+    def center_on(self, x:float, y:float):
+        self.x = x - self.width / 2
+        self.y = y - self.height / 2
+
+    def visible_chunks(self):
+        first_cx = int(self.x // CHUNK_PIXELS)
+        first_cy = int(self.y // CHUNK_PIXELS)
+        last_cx = int((self.x + self.width - 1) // CHUNK_PIXELS)
+        last_cy = int((self.y + self.height - 1) // CHUNK_PIXELS)
+        for cy in range(first_cy, last_cy + 1):
+            for cx in range(first_cx, last_cx + 1):
+                yield cx, cy
+
+    def render(self, surface, world, offset=(0, 0)):
+        """Blits the visible chunks (baking the ones that changed), returns the rect drawn over."""
+        blits = []
+        for cx, cy in self.visible_chunks():
+            chunk = world.get_chunk(cx, cy)
+            position = (int(cx * CHUNK_PIXELS - self.x) + offset[0], int(cy * CHUNK_PIXELS - self.y) + offset[1])
+            blits.append((world.get_chunk_surface(chunk), position))
+        surface.blits(blits, doreturn=False)
+        return pygame.Rect(offset, (self.width, self.height))
@@ -0,0 +1,137 @@
+"""
+World generation for RPGOnline.
+
+Terrain is made from seeded value noise, computed for a whole chunk at once with NumPy.
+The noise only depends on the seed and the world position of each tile (integer hashing, no random state), so a chunk comes out bit-identical no matter which process makes it, how many workers there are or in what order chunks are asked for. That's what lets servers and clients agree on terrain.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+try:
+    from modules.world import Chunk, CHUNK_SIZE, AIR
+except ImportError:
+    from world import Chunk, CHUNK_SIZE, AIR
+
+# Tile ids
+GRASS = 1
+DIRT = 2
+STONE = 3
+
+SEA_LEVEL = 0  # World tile y the surface wobbles around (y grows downwards)
+SURFACE_AMPLITUDE = 24
+SURFACE_SCALE = 64
+DIRT_DEPTH = 4
+CAVE_SCALE = 16
+CAVE_THRESHOLD = 0.72
+
+MASK_64 = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+def hash_coords(seed:int, x, y):
+    """A well mixed 64-bit hash of integer coordinates, turned into floats in [0, 1)."""
+    x = np.asarray(x, np.int64).astype(np.uint64)
+    y = np.asarray(y, np.int64).astype(np.uint64)
+    h = x * np.uint64(0x9E3779B97F4A7C15) ^ y * np.uint64(0xC2B2AE3D27D4EB4F) ^ np.uint64(seed & 0xFFFFFFFFFFFFFFFF)
+    # splitmix64 finalizer
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    h = h ^ (h >> np.uint64(31))
+    return (h >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+def value_noise(seed:int, xs, ys, scale:float):
+    """Smoothly interpolated noise in [0, 1) at the world positions 'xs', 'ys' (arrays of the same shape)."""
+    fx = np.asarray(xs, np.float64) / scale
+    fy = np.asarray(ys, np.float64) / scale
+    x0 = np.floor(fx)
+    y0 = np.floor(fy)
+    tx = fx - x0
+    ty = fy - y0
+    x0 = x0.astype(np.int64)
+    y0 = y0.astype(np.int64)
+    # Smoothstep, so the lattice doesn't show
+    tx = tx * tx * (3 - 2 * tx)
+    ty = ty * ty * (3 - 2 * ty)
+    top = hash_coords(seed, x0, y0) * (1 - tx) + hash_coords(seed, x0 + 1, y0) * tx
+    bottom = hash_coords(seed, x0, y0 + 1) * (1 - tx) + hash_coords(seed, x0 + 1, y0 + 1) * tx
+    return top * (1 - ty) + bottom * ty
+
+def fractal_noise(seed:int, xs, ys, scale:float, octaves:int = 4, persistence:float = 0.5):
+    """Several octaves of value noise added up, normalized back to [0, 1)."""
+    total = np.zeros(np.shape(xs), np.float64)
+    amplitude = 1.0
+    amplitudes = 0.0
+    for octave in range(octaves):
+        total += value_noise(seed + octave * 1013, xs, ys, scale) * amplitude
+        amplitudes += amplitude
+        amplitude *= persistence
+        scale /= 2
+    return total / amplitudes
+
+def generate_chunk_arrays(seed:int, cx:int, cy:int):
+    """The tile, metadata and light arrays of chunk (cx, cy). Runs in the worker processes, so it only deals with plain arrays."""
+    columns = np.arange(CHUNK_SIZE, dtype=np.int64) + cx * CHUNK_SIZE
+    rows = np.arange(CHUNK_SIZE, dtype=np.int64) + cy * CHUNK_SIZE
+    xs, ys = np.meshgrid(columns, rows)
+
+    # One surface height per column
+    heights = SEA_LEVEL + np.floor((fractal_noise(seed, columns, np.zeros_like(columns), SURFACE_SCALE) - 0.5) * 2 * SURFACE_AMPLITUDE).astype(np.int64)
+    depth = ys - heights[np.newaxis, :]
+
+    tiles = np.full((CHUNK_SIZE, CHUNK_SIZE), AIR, np.uint16)
+    tiles[depth == 0] = GRASS
+    tiles[(depth > 0) & (depth <= DIRT_DEPTH)] = DIRT
+    tiles[depth > DIRT_DEPTH] = STONE
+
+    # Caves, only underground
+    caves = fractal_noise(seed + 7919, xs, ys, CAVE_SCALE, octaves=3) > CAVE_THRESHOLD
+    tiles[caves & (depth > 2)] = AIR
+
+    metadata = np.zeros((CHUNK_SIZE, CHUNK_SIZE), np.uint8)
+    # Darker the deeper it goes
+    light = np.clip(255 - np.maximum(depth, 0) * 8, 40, 255).astype(np.uint8)
+    return tiles, metadata, light
+
+def generate_chunk(seed:int, cx:int, cy:int):
+    return Chunk(cx, cy, *generate_chunk_arrays(seed, cx, cy))
+
+class ChunkGenerator():
+    """
+    Generates chunks on a process pool, so the chunks around the player are ready before they're needed without stalling the render loop.
+    request() chunks ahead of time, call poll(world) once per frame to put the finished ones in the world.
+    If the world needs a chunk that isn't ready yet, use generate_now (it can be the World's generator).
+    """
+    def __init__(self, seed:int, workers:int = None) -> None:
+        self.seed = seed
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.pending = {}
+
+    def request(self, cx:int, cy:int):
+        if (cx, cy) not in self.pending:
+            self.pending[(cx, cy)] = self.executor.submit(generate_chunk_arrays, self.seed, cx, cy)
+
+    def request_around(self, world, cx:int, cy:int, radius:int):
+        """Requests the missing chunks within 'radius' of (cx, cy), closest first."""
+        around = [(x, y) for y in range(cy - radius, cy + radius + 1) for x in range(cx - radius, cx + radius + 1)]
+        around.sort(key=lambda position: (position[0] - cx) ** 2 + (position[1] - cy) ** 2)
+        for x, y in around:
+            if world.get_chunk(x, y, create=False) is None:
+                self.request(x, y)
+
+    def poll(self, world):
+        """Adds the chunks that finished generating to 'world', returns how many."""
+        finished = [position for position, future in self.pending.items() if future.done()]
+        for position in finished:
+            future = self.pending.pop(position)
+            # It might have been made with generate_now in the meantime
+            if world.get_chunk(*position, create=False) is None:
+                world.add_chunk(Chunk(position[0], position[1], *future.result()))
+        return len(finished)
+
+    def generate_now(self, cx:int, cy:int):
+        future = self.pending.pop((cx, cy), None)
+        if future is not None and future.done():
+            return Chunk(cx, cy, *future.result())
+        return generate_chunk(self.seed, cx, cy)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
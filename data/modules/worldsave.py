@@ -0,0 +1,200 @@
+"""
+World saves for RPGOnline.
+
+Chunks are grouped into region files of REGION_SIZE x REGION_SIZE chunks. Every chunk is compressed on its own, and a table at the start of the file has the offset and length of each one.
+Regions are memory-mapped, so loading a chunk only reads and decompresses that chunk.
+Saving only writes the chunks that changed. It compresses them on a background thread, copies the untouched chunks over from the old file as they are, and swaps the new file in with an atomic replace, so a crash mid-save never leaves a broken region.
+"""
+
+import mmap
+import os
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+try:
+    from modules.world import Chunk, CHUNK_SIZE
+except ImportError:
+    from world import Chunk, CHUNK_SIZE
+
+REGION_SIZE = 16  # Chunks per region side
+SLOTS = REGION_SIZE * REGION_SIZE
+MAGIC = b"RPGREG\x00\x01"
+ENTRY = struct.Struct("<QI")  # Offset and length of a chunk, a length of 0 means it isn't there
+HEADER_SIZE = len(MAGIC) + ENTRY.size * SLOTS
+TILE_BYTES = CHUNK_SIZE * CHUNK_SIZE * 2
+LAYER_BYTES = CHUNK_SIZE * CHUNK_SIZE
+
+def encode_chunk(tiles, metadata, light):
+    return zlib.compress(tiles.astype("<u2").tobytes() + metadata.tobytes() + light.tobytes(), 6)
+
+def decode_chunk(cx:int, cy:int, data):
+    raw = zlib.decompress(data)
+    tiles = np.frombuffer(raw, "<u2", CHUNK_SIZE * CHUNK_SIZE, 0).astype(np.uint16).reshape(CHUNK_SIZE, CHUNK_SIZE)
+    metadata = np.frombuffer(raw, np.uint8, LAYER_BYTES, TILE_BYTES).reshape(CHUNK_SIZE, CHUNK_SIZE).copy()
+    light = np.frombuffer(raw, np.uint8, LAYER_BYTES, TILE_BYTES + LAYER_BYTES).reshape(CHUNK_SIZE, CHUNK_SIZE).copy()
+    return Chunk(cx, cy, tiles, metadata, light)
+
+def region_coords(cx:int, cy:int):
+    """Region of a chunk and the chunk's slot in it."""
+    return cx // REGION_SIZE, cy // REGION_SIZE, (cy % REGION_SIZE) * REGION_SIZE + cx % REGION_SIZE
+
+class RegionFile():
+    """A memory-mapped region file, read only. An empty or missing file just has no chunks."""
+    def __init__(self, path:str) -> None:
+        self.path = path
+        self.file = None
+        self.data = None
+        self.table = [(0, 0)] * SLOTS
+        if os.path.exists(path) and os.path.getsize(path) >= HEADER_SIZE:
+            self.file = open(path, "rb")
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.data[:len(MAGIC)] != MAGIC:
+                self.close()
+                raise ValueError(f"'{path}' isn't an RPGOnline region file")
+            self.table = [ENTRY.unpack_from(self.data, len(MAGIC) + slot * ENTRY.size) for slot in range(SLOTS)]
+
+    def read(self, slot:int):
+        """The compressed bytes of a chunk, or None."""
+        offset, length = self.table[slot]
+        if not length:
+            return None
+        return self.data[offset:offset + length]
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.file.close()
+        self.data = None
+        self.file = None
+        self.table = [(0, 0)] * SLOTS
+
+def write_region(path:str, old, changed:dict):
+    """
+    Writes a region made of the chunks in 'old' (a RegionFile) with the compressed chunks in 'changed' (slot -> bytes) on top, next to 'path'.
+    Returns the path of the new file, it's swapped in by WorldStorage so 'old' stays readable until then.
+    """
+    blobs = []
+    for slot in range(SLOTS):
+        blob = changed.get(slot)
+        if blob is None:
+            blob = old.read(slot)
+        blobs.append(blob)
+
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as file:
+        table = []
+        offset = HEADER_SIZE
+        for blob in blobs:
+            if blob is None:
+                table.append(ENTRY.pack(0, 0))
+            else:
+                table.append(ENTRY.pack(offset, len(blob)))
+                offset += len(blob)
+        file.write(MAGIC)
+        file.write(b"".join(table))
+        for blob in blobs:
+            if blob is not None:
+                file.write(blob)
+        file.flush()
+        os.fsync(file.fileno())
+    return temporary_path
+
+class WorldStorage():
+    """
+    A world folder full of region files.
+    load_chunk reads single chunks, save(world) writes the dirty ones in the background (one save at a time, in order).
+    """
+    def __init__(self, directory:str) -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.regions = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.last_save = None
+
+    def region_path(self, rx:int, ry:int):
+        return os.path.join(self.directory, f"r.{rx}.{ry}.region")
+
+    def get_region(self, rx:int, ry:int):
+        region = self.regions.get((rx, ry))
+        if region is None:
+            region = RegionFile(self.region_path(rx, ry))
+            self.regions[(rx, ry)] = region
+        return region
+
+    def load_chunk(self, cx:int, cy:int):
+        rx, ry, slot = region_coords(cx, cy)
+        with self.lock:
+            data = self.get_region(rx, ry).read(slot)
+        if data is None:
+            return None
+        return decode_chunk(cx, cy, data)
+
+    def chunk_source(self, generator=None):
+        """A function for World's generator: loads saved chunks, and makes new ones with 'generator' (or empty ones)."""
+        def load_or_generate(cx, cy):
+            chunk = self.load_chunk(cx, cy)
+            if chunk is None:
+                chunk = generator(cx, cy) if generator is not None else Chunk(cx, cy)
+                # Never saved, so it has to be
+                chunk.dirty = True
+            return chunk
+        return load_or_generate
+
+    def save(self, world, wait:bool = False):
+        """
+        Saves the chunks of 'world' that changed since the last save. Only copying their arrays happens right away, compressing and writing happens in the background.
+        If the write fails the chunks are marked dirty again, so the next save tries them again. Returns the future of the save, with wait=True the error gets raised.
+        """
+        by_region = {}
+        saved = []
+        for chunk in world.chunks.values():
+            if chunk.dirty:
+                rx, ry, slot = region_coords(chunk.cx, chunk.cy)
+                by_region.setdefault((rx, ry), {})[slot] = (chunk.tiles.copy(), chunk.metadata.copy(), chunk.light.copy())
+                # Cleared now so edits made during the save count for the next one
+                chunk.dirty = False
+                saved.append(chunk)
+
+        self.last_save = self.executor.submit(self.write_save, by_region, saved)
+        if wait:
+            self.last_save.result()
+        return self.last_save
+
+    def write_save(self, by_region:dict, chunks:list):
+        try:
+            return self.write_regions(by_region)
+        except Exception as error:
+            # Marked before the future finishes, so a save started right after a failed one picks them up
+            print(f"Couldn't save the world to '{self.directory}', keeping {len(chunks)} chunks for the next save: {error}")
+            for chunk in chunks:
+                chunk.dirty = True
+            raise
+
+    def write_regions(self, by_region:dict):
+        for (rx, ry), chunks in by_region.items():
+            changed = {slot: encode_chunk(*arrays) for slot, arrays in chunks.items()}
+            path = self.region_path(rx, ry)
+            with self.lock:
+                old = self.get_region(rx, ry)
+            # Written and flushed without the lock, so loading chunks never waits on the disk. Only this thread closes regions, so 'old' stays mapped meanwhile
+            temporary_path = write_region(path, old, changed)
+            with self.lock:
+                try:
+                    # The old file can't be replaced while it's mapped (on Windows)
+                    old.close()
+                    os.replace(temporary_path, path)
+                finally:
+                    # Closed either way, map whatever file is there next time it's needed
+                    del self.regions[(rx, ry)]
+        return sum(len(chunks) for chunks in by_region.values())
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            for region in self.regions.values():
+                region.close()
+            self.regions.clear()
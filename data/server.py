@@ -0,0 +1,67 @@
+"""
+The headless RPGOnline server.
+
+    python data/server.py                          serve on 127.0.0.1:24680
+    python data/server.py --simulate 50 --duration 30
+                                                   load test: serve and connect 50 simulated clients to it, then print the stats
+    python data/server.py --benchmark              tick cost and bandwidth as players and entities grow, with and without interest management
+"""
+
+import argparse
+import asyncio
+import modules.serverengine as ServerEngine
+
+async def load_test(engine, host, port, clients, duration, report_interval):
+    reports = []
+    def on_report(report):
+        reports.append(report)
+        print(ServerEngine.format_report(report))
+
+    server = asyncio.create_task(engine.run(host, port, duration + 1, report_interval, on_report))
+    # Give the server a moment to start listening
+    await asyncio.sleep(0.2)
+    received = await asyncio.gather(*(ServerEngine.simulated_client(host, port, f"bot{index}", duration, seed=index) for index in range(clients)))
+    engine.stop()
+    await server
+    print(f"{clients} simulated clients got {sum(received) / max(clients, 1):.0f} snapshots each on average")
+    return reports
+
+def run_benchmark(interest_radius):
+    print("players  entities  | everything: tick ms  bytes/player/tick | interest: tick ms  bytes/player/tick")
+    for npcs in (1000, 10000):
+        for players in (1, 10, 50, 100):
+            everything = ServerEngine.benchmark(players, npcs, interest_radius=None)
+            interest = ServerEngine.benchmark(players, npcs, interest_radius=interest_radius)
+            print(f"{players:7d}  {npcs:8d}  | {everything[0]:19.2f}  {everything[1]:17.0f} | {interest[0]:17.2f}  {interest[1]:17.0f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="The headless RPGOnline server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=24680)
+    parser.add_argument("--tick-rate", type=int, default=20)
+    parser.add_argument("--npcs", type=int, default=0, help="wandering entities to spawn")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report-interval", type=float, default=5.0, help="seconds between stats reports")
+    parser.add_argument("--simulate", type=int, default=0, help="connect this many simulated clients (load test)")
+    parser.add_argument("--duration", type=float, default=None, help="stop after this many seconds")
+    parser.add_argument("--interest-radius", type=int, default=2, help="chunks around a player that it gets updates for, -1 sends everything")
+    parser.add_argument("--benchmark", action="store_true", help="benchmark ticks without sockets, then quit")
+    arguments = parser.parse_args()
+    interest_radius = arguments.interest_radius if arguments.interest_radius >= 0 else None
+
+    if arguments.benchmark:
+        run_benchmark(interest_radius if interest_radius is not None else 2)
+        return
+
+    engine = ServerEngine.ServerEngine(tick_rate=arguments.tick_rate, npcs=arguments.npcs, seed=arguments.seed, interest_radius=interest_radius)
+    if arguments.simulate:
+        asyncio.run(load_test(engine, arguments.host, arguments.port, arguments.simulate, arguments.duration or 10.0, arguments.report_interval))
+    else:
+        print(f"Serving on {arguments.host}:{arguments.port}")
+        try:
+            asyncio.run(engine.run(arguments.host, arguments.port, arguments.duration, arguments.report_interval))
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()